@@ -1,15 +1,152 @@
+import json
+import re
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
 from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+from django.test import RequestFactory
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from django.utils.http import urlencode
 from ctrs_texts.models import (
     Repository, Manuscript, AbstractedText, EncodedText,
-    AbstractedTextType, EncodedTextStatus
+    AbstractedTextType, EncodedTextStatus, EncodedTextType, Sentence
 )
 from django.utils.text import slugify
-from ctrs_texts.utils import get_xml_from_unicode, get_unicode_from_xml
+from ctrs_texts import serializers
+from ctrs_texts.search import get_highlight_pattern
+from ctrs_texts.utils import (
+    get_xml_from_unicode, get_unicode_from_xml,
+    get_plain_text_from_content, iter_json_array_items, get_batches,
+    get_content_hash, highlight_html, bump_api_cache_version
+)
+
+
+def clean_archetype_text_content(content):
+    # non-breaking spaces -> normal spaces
+    ret = (content or '').replace('&nbsp;', '').replace('\xA0', ' ')
+
+    # allow the empty symbol to be styled
+    ret = ret.replace('∅', '<span class="no-text">∅</span>')
+
+    # ac-128: add an empty-region class the spans that only contains an
+    # empty symbol
+    ret = re.sub(
+        r'(<span[^>]+data-dpt-type="unsettled"[^>]*)(>\s*∅\s*</span>)',
+        r'\1 class="empty-region"\2',
+        ret
+    )
+
+    # Minor XML transforms
+    xml = get_xml_from_unicode(ret, ishtml=True, add_root=True)
+
+    counters = {
+        'version': 0,
+        'work': 0,
+    }
+
+    for region in xml.findall('.//span[@data-dpt-type="unsettled"]'):
+        # add data-dpt-group="version" to the v-regions
+        region_type = 'work'
+        if not region.attrib.get('data-dpt-group', None):
+            region_type = 'version'
+            region.attrib['data-dpt-group'] = region_type
+
+        # assign short id to all regions
+        counters[region_type] += 1
+        region.attrib['data-rid'] = '{}-{}'.format(
+            region_type[0], counters[region_type]
+        )
+
+    for sn in xml.findall('.//span[@data-dpt="sn"]'):
+        # add short if to all sentence number
+        sn.attrib['data-rid'] = 's-' + str(sn.text.strip())
+
+    ret = get_unicode_from_xml(xml, remove_root=True)
+
+    return ret
+
+
+def get_clean_content_and_plain_text(content):
+    '''
+    Returns (cleaned content, plain text) from an Archetype XML content.
+    None if content is None.
+    Module-level so it can run in a worker process (ctrstxt import --jobs).
+    '''
+    if content is None:
+        return None
+    ret = clean_archetype_text_content(content)
+    return ret, get_plain_text_from_content(ret)
+
+
+def get_contents_with_unique_readings(contents, regions):
+    '''
+    Marks up the unique readings in the contents of the members of a group.
+
+    contents: the XML content of each member (None if it has no text)
+    regions: [[(reading, span id), ...], ...], the variants of each
+        collated region, one per member
+
+    A region element gets data-copies="1" if its reading is not found
+    in any other member; a mark left by a previous run is removed
+    if the reading is no longer unique (e.g. the content of another
+    member has changed since, the unchanged members are not reimported).
+
+    Returns (new_contents, missing)
+    new_contents: the new content of each member, None if unchanged
+    missing: [(region index, member index), ...] for the unique readings
+        which element was not found
+    Module-level so it can run in a worker process (ctrstxt unique --jobs).
+    '''
+    # {span id: span element} for each member, the first one wins
+    spans = []
+    xmls = []
+    for content in contents:
+        spans.append({})
+        xmls.append(None)
+        if content is None:
+            continue
+        xmls[-1] = get_xml_from_unicode(content, ishtml=True, add_root=True)
+        for el in xmls[-1].iter('span'):
+            spans[-1].setdefault(el.attrib.get('id'), el)
+
+    changed = [False] * len(contents)
+    missing = []
+
+    for ri, region in enumerate(regions):
+        counts = Counter(reading for reading, _ in region)
+        for mi, (reading, span_id) in enumerate(region):
+            el = spans[mi].get(span_id) if span_id else None
+            if counts[reading] != 1:
+                if el is not None and el.attrib.get('data-copies') == '1':
+                    del el.attrib['data-copies']
+                    changed[mi] = True
+                continue
+            if el is None:
+                missing.append((ri, mi))
+                continue
+            if el.attrib.get('data-copies') != '1':
+                el.attrib['data-copies'] = '1'
+                changed[mi] = True
+
+    new_contents = [
+        get_unicode_from_xml(xml, remove_root=True) if changed[mi] else None
+        for mi, xml in enumerate(xmls)
+    ]
+
+    return new_contents, missing
 
 
 class Command(BaseCommand):
     help = 'CTRS text management toolbox'
 
+    # number of records read and written at a time by import
+    BATCH_SIZE = 100
+
     def log(self, message, verbosity=1):
         if verbosity <= self.get_verbosity():
             self.stdout.write(message)
@@ -23,16 +160,57 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('action', nargs='?', type=str)
         parser.add_argument('options', nargs='*', type=str)
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help='number of processes used by import and unique'
+        )
+        parser.add_argument(
+            '--warm', action='store_true',
+            help='import: warm up the caches after the import'
+        )
+        parser.add_argument(
+            '--group', action='append', metavar='SLUG',
+            help='unique: only process this group (text slug), repeatable'
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='import: reprocess all the texts, even if unchanged'
+        )
 
     def handle(self, *args, **options):
         action = options['action']
         self.options = options['options']
+        self.jobs = options.get('jobs') or 1
+        self.force = options.get('force', False)
+        self.groups = options.get('group', None)
+        self.warm = options.get('warm', False)
         self.verbosity = options['verbosity']
+        # {phase name: seconds}, see phase()
+        self.timings = OrderedDict()
 
         valid = False
 
+        try:
+            valid = self.handle_action(action)
+        finally:
+            if action in ['import', 'delete', 'unique']:
+                # the texts are written in bulk, without save()
+                bump_api_cache_version()
+
+        if valid and action == 'import' and self.warm:
+            # after the cache version has changed
+            self.action_warm()
+
+        if not valid:
+            self.show_help()
+        else:
+            self.log('done')
+
+    def handle_action(self, action):
+        ret = False
+
         if action == 'import':
-            valid = self.handle_import()
+            ret = self.handle_import()
 
         if action == 'delete':
             for m in [
@@ -41,15 +219,18 @@ class Command(BaseCommand):
                 EncodedTextStatus
             ]:
                 m.objects.all().delete()
-            valid = True
+            ret = True
 
         if action == 'unique':
-            valid = self.handle_unique()
+            ret = self.handle_unique_action()
 
-        if not valid:
-            self.show_help()
-        else:
-            self.log('done')
+        if action == 'bench':
+            ret = self.handle_bench()
+
+        if action == 'warm':
+            ret = self.action_warm()
+
+        return ret
 
     def handle_import(self):
         '''
@@ -62,32 +243,328 @@ class Command(BaseCommand):
         if len(self.options) != 1:
             return ret
 
-        ret = True
-
         file_path = self.options.pop(0)
-        self.action_import(file_path)
+        ret = self.action_import(file_path)
 
         return ret
 
-    def action_import(self, input_file):
-        data = None
+    def action_warm(self):
+        '''
+        Pre-populates the caches of the API responses
+        (see views.texts_json.api_response_cache)
+        by requesting the list of texts, the default requests of the
+        search page and the chunks of all the texts in all the views.
+        With --jobs N, N requests at a time.
+
+        The comparative chunks (/api/texts/ID1,ID2,.../VIEW/whole/whole/)
+        are only requested by the viewer for the combinations of texts
+        of a link (?blocks=), too many to be warmed.
+        Their paths can be passed as options: warm PATH [PATH ...]
+        '''
+        paths = ['/api/texts/', '/api/texts/?group=declaration']
+
+        paths.extend(self.get_search_paths())
+
+        for text_id in AbstractedText.objects.exclude(
+            short_name__in=['HM1', 'HM2']
+        ).order_by('id').values_list('id', flat=True):
+            for view in ['transcription', 'translation', 'histogram']:
+                paths.append('/api/texts/{}/{}/whole/whole/'.format(
+                    text_id, view
+                ))
+
+        paths.extend(self.options)
+
+        t0 = time.time()
+        # {view name: [duration, ...]}
+        durations = OrderedDict()
+        errors = 0
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for path, status, duration in executor.map(
+                self.warm_path, paths
+            ):
+                self.log('{} {} {:.3f}s'.format(status, path, duration), 2)
+                if status != 200:
+                    errors += 1
+                name = path.split('?')[0].strip('/').split('/')
+                name = name[3] if len(name) > 3 else 'texts'
+                durations.setdefault(name, []).append(duration)
+
+        for name, ds in durations.items():
+            self.log('{}: {} requests, {:.3f}s total, {:.3f}s max'.format(
+                name, len(ds), sum(ds), max(ds)
+            ))
+        self.log('{} requests, {} errors, {:.3f}s'.format(
+            len(paths), errors, time.time() - t0
+        ))
+
+        return True
+
+    def get_search_texts(self):
+        '''
+        Returns [(id, siglum, group id), ...] of the texts of the search page
+        in the order of /api/texts/?group=declaration
+        '''
+        return list(AbstractedText.objects.filter(
+            Q(slug='declaration') | Q(group__slug='declaration') | Q(
+                group__group__slug='declaration'
+            )
+        ).exclude(
+            short_name__in=['HM1', 'HM2']
+        ).order_by(
+            '-type__slug', 'short_name', 'locus'
+        ).values_list('id', 'short_name', 'group_id'))
 
-        import json
+    def get_search_paths(self):
+        '''
+        Returns the paths of the requests of the search page
+        with its default facets: the sentences and the heatmap
+        of the preselected texts (V1 and its members) and of all the texts.
+        '''
+        texts = self.get_search_texts()
+
+        selections = [[text[0] for text in texts]]
+        # PRESELECTED_TEXT_SIGLA in text_search.js
+        for text in texts:
+            if (text[1] or '').lower() == 'v1':
+                # the first text with that siglum and its members
+                selections.insert(0, [
+                    member[0] for member in texts
+                    if text[0] in [member[0], member[2]]
+                ])
+                break
+
+        ret = []
+        for text_ids in selections:
+            for result_type in ['sentences', 'regions']:
+                path = self.get_search_path(result_type, text_ids)
+                if path not in ret:
+                    ret.append(path)
+
+        return ret
+
+    def get_search_path(self, result_type, text_ids):
+        '''
+        Returns the path of the search request for text_ids
+        with the same parameters as text_search.js fetch_results()
+        as the key of the cached response depends on them.
+        '''
+        return '/api/texts/search/{}/?{}'.format(result_type, urlencode([
+            ['texts', ','.join(str(text_id) for text_id in text_ids)],
+            ['et', 'transcription'],
+            ['sn', 1],
+            ['q', ''],
+        ]))
+
+    def warm_path(self, path):
+        '''
+        Calls the API view of path (with its query string).
+        Returns (path, response status, duration in seconds)
+        '''
+        t0 = time.time()
         try:
-            with open(input_file, 'rt') as fh:
-                data = json.load(fh)
+            match = resolve(path.split('?')[0])
+            response = match.func(
+                RequestFactory().get(path), *match.args, **match.kwargs
+            )
+            status = response.status_code
+            if response.streaming:
+                # a streamed response is cached once it has been sent
+                for _ in response.streaming_content:
+                    pass
+            response.close()
+        except Resolver404:
+            status = 404
         except Exception as e:
-            self.error('%s' % e)
+            # don't stop the other requests
+            self.error('{}: {}: {}'.format(path, e.__class__.__name__, e))
+            status = 500
+        finally:
+            # the database connections are per thread
+            connections.close_all()
+
+        return path, status, time.time() - t0
+
+    def handle_bench(self):
+        '''
+        Benchmarks some operations over the whole corpus.
+        bench highlight [QUERY ...]
+        bench json [REPEAT]
+        '''
+        if not self.options:
+            return False
+
+        benchmark = getattr(self, 'bench_' + self.options.pop(0), None)
+        if benchmark is None:
             return False
 
-        ret = self.import_json(data)
+        return benchmark(*self.options)
+
+    def bench_highlight(self, *queries):
+        '''
+        Compares the highlighting of the search results in all the
+        sentences with the linear utils.highlight_html()
+        and with the regex lookahead used before.
+        Also on the longest sentence repeated 1, 10 and 100 times,
+        the lookahead is quadratic in the length of the html.
+        '''
+        queries = queries or ['e', 'nemo', 'simul bonus']
+        repeats = [1, 10, 100]
+
+        htmls = list(Sentence.objects.values_list('html', flat=True))
+        longest = max(htmls, key=len) if htmls else ''
+        self.log('{} sentences, longest: {} chars'.format(
+            len(htmls), len(longest)
+        ))
+
+        for query in queries:
+            pattern = get_highlight_pattern(query)
+            if pattern is None:
+                self.log('{!r}: skipped, no word to highlight'.format(query))
+                continue
+            # the pattern used before
+            lookahead = re.compile(
+                '({})(?=(?:[^>]|<[^>]*>)*$)'.format(pattern.pattern), re.I
+            )
+
+            results = []
+            for name, highlight in [
+                ('lookahead', lambda html: lookahead.sub(
+                    r'<span class="highlight">\1</span>', html
+                )),
+                ('linear', lambda html: highlight_html(html, pattern)),
+            ]:
+                t0 = time.time()
+                results.append([highlight(html) for html in htmls])
+                durations = [time.time() - t0]
+                for repeat in repeats:
+                    t0 = time.time()
+                    highlight(longest * repeat)
+                    durations.append(time.time() - t0)
+
+                self.log('{!r} {}: all {:.1f}ms, longest {}'.format(
+                    query, name, durations[0] * 1000, ', '.join([
+                        'x{} {:.1f}ms'.format(repeat, duration * 1000)
+                        for repeat, duration in zip(repeats, durations[1:])
+                    ])
+                ))
+
+            self.log('{!r}: {} different results'.format(
+                query, sum(1 for a, b in zip(*results) if a != b)
+            ))
+
+        return True
+
+    def bench_json(self, repeat='20'):
+        '''
+        Compares the time taken by the json encoders to encode
+        the list of texts and the heatmap, see ctrs_texts.serializers.
+        The heatmap is also encoded with its annotations pre-serialized.
+        '''
+        repeat = int(repeat)
+
+        payloads = OrderedDict()
+        for name, path in [
+            ['texts', '/api/texts/'],
+            ['heatmap', self.get_search_path('regions', [
+                text[0] for text in self.get_search_texts()
+            ])],
+        ]:
+            match = resolve(path.split('?')[0])
+            response = match.func(
+                RequestFactory().get(path), *match.args, **match.kwargs
+            )
+            payloads[name] = json.loads(
+                response.getvalue().decode('utf-8'),
+                object_pairs_hook=OrderedDict
+            )
 
-        if ret:
-            ret = self.handle_unique()
+        for name, payload in payloads.items():
+            for encoder in serializers.get_encoder_names():
+                encodings = [
+                    ['', lambda: serializers.dumps(payload, encoder)],
+                ]
+                if name == 'heatmap':
+                    # the annotations encoded once, as in the API
+                    heatmap = payload['data'][0]
+                    fragment = OrderedDict(heatmap)
+                    fragment['annotations'] = serializers.JSONFragment(
+                        serializers.dumps(heatmap['annotations'], encoder)
+                    )
+                    fragment = OrderedDict(payload, data=[fragment])
+                    encodings.append([
+                        ', pre-serialized annotations',
+                        lambda: ''.join(
+                            serializers.iter_json(fragment, encoder)
+                        )
+                    ])
+
+                for label, encode in encodings:
+                    durations = []
+                    for i in range(repeat):
+                        t0 = time.time()
+                        size = len(encode())
+                        durations.append(time.time() - t0)
+                    self.log('{} ({} chars), {}{}: {:.2f}ms'.format(
+                        name, size, encoder, label, min(durations) * 1000
+                    ))
+
+        return True
+
+    def handle_unique_action(self):
+        parent_ids = None
+        if self.groups:
+            parent_ids = self.get_group_ids(self.groups)
+            if parent_ids is None:
+                return False
+
+        with self.phase('unique'):
+            ret = self.handle_unique(parent_ids)
+
+        self.log_timings()
+
+        return ret
+
+    def action_import(self, input_file):
+        def get_records():
+            with open(input_file, 'rt') as fh:
+                yield from iter_json_array_items(fh, 'results')
+
+        try:
+            # the import and the unique readings in the same transaction,
+            # the database is unchanged if anything fails
+            with transaction.atomic():
+                parent_ids, text_ids = self.import_records(get_records)
+
+                with self.phase('unique'):
+                    ret = self.handle_unique(parent_ids, text_ids)
+        except (OSError, ValueError) as e:
+            self.error('%s' % e)
+            return False
+
+        self.log_timings()
 
         return ret
 
-    def handle_unique(self):
+    def handle_unique(self, parent_ids=None, text_ids=None):
+        '''
+        Mark up the unique readings in the members of the given parents
+        then rebuild the content with readings.
+
+        parent_ids: ids of the AbstractedTexts of the groups to process,
+            None for all the groups.
+        text_ids: ids of other AbstractedTexts which need their readings
+            rebuilt.
+
+        Only the readings of the given texts and of the parents
+        which members' markup has changed are rebuilt.
+
+        The groups are independent from each other (a text is a member of
+        only one group), so with --jobs N > 1 they are processed
+        by a pool of N processes.
+        Only the members which markup has changed are written back.
+        '''
         # get all versions and works
         parents = EncodedText.objects.filter(
             abstracted_text__type__slug__in=['work', 'version']
@@ -95,192 +572,569 @@ class Command(BaseCommand):
             abstracted_text__short_name__in=['HM1', 'HM2']
         ).order_by(
             'abstracted_text__type__slug', 'abstracted_text__short_name'
-        )
+        ).select_related('abstracted_text__type')
 
-        for parent in parents:
-            regions, members = parent.get_readings_from_members()
+        if parent_ids is not None:
+            parents = parents.filter(abstracted_text_id__in=parent_ids)
 
-            encoded_texts = [
-                member.encoded_texts.filter(type=parent.type).first()
-                for member in members
-            ]
+        readings = EncodedText.get_readings_from_members_bulk(parents)
 
-            xmls = [
-                get_xml_from_unicode(text.content, ishtml=True, add_root=True)
-                for text in encoded_texts
-            ]
+        # AbstractedText ids of the texts to rebuild the readings of
+        readings_ids = set(text_ids or [])
 
-            for ri, region in enumerate(regions):
-                groups = {}
-                for mi, variants in enumerate(region):
-                    variants['mi'] = mi
-                    if variants['reading'] not in groups:
-                        groups[variants['reading']] = []
-                    groups[variants['reading']].append(variants)
-
-                for reading, group in groups.items():
-                    # print(reading, len(group))
-                    if len(group) != 1:
-                        continue
-                    # print('unique')
-                    for variant in group:
-                        el = xmls[variant['mi']].find(
-                            './/span[@id="{}"]'.format(variant['id']))
-                        if el is None:
-                            print(
-                                'WARNING: region not found ({} in {})'.format(
-                                    ri, members[variant['mi']].short_name
-                                )
-                            )
-                            continue
-                        el.attrib['data-copies'] = '1'
-
-            for mi, encoded_text in enumerate(encoded_texts):
-                encoded_text.content = get_unicode_from_xml(
-                    xmls[mi], remove_root=True
+        args = [[], []]
+        for parent in parents:
+            regions, members, encoded_texts = readings[parent.id]
+            args[0].append([
+                text.content if text else None for text in encoded_texts
+            ])
+            args[1].append([
+                [(v['reading'], v['id']) for v in region]
+                for region in regions
+            ])
+
+        if self.jobs < 2:
+            results = list(map(get_contents_with_unique_readings, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(
+                    executor.map(get_contents_with_unique_readings, *args)
                 )
-                # print(encoded_text.abstracted_text.id)
-                encoded_text.save()
+
+        changed_texts = []
+        for parent, (new_contents, missing) in zip(parents, results):
+            regions, members, encoded_texts = readings[parent.id]
+            for ri, mi in missing:
+                print('WARNING: region not found ({} in {})'.format(
+                    ri, members[mi].short_name
+                ))
+            for encoded_text, content in zip(encoded_texts, new_contents):
+                if content is None:
+                    continue
+                encoded_text.content = content
+                changed_texts.append(encoded_text)
+                readings_ids.update([
+                    encoded_text.abstracted_text_id,
+                    parent.abstracted_text_id,
+                ])
+
+        with transaction.atomic():
+            # the plain text is not affected by the markup
+            self.bulk_update(EncodedText, changed_texts, ['content'])
+            EncodedText.update_indexes(changed_texts)
+
+            rebuilt = self.update_readings(readings_ids)
+
+        self.log('{} members changed, {} parent texts, {} rebuilt.'.format(
+            len(changed_texts), len(readings), rebuilt
+        ))
 
         return True
 
-    def import_json(self, data):
+    def get_group_ids(self, group_slugs):
+        '''
+        Returns the ids of the AbstractedTexts which match the slugs
+        or which are the members of the matching texts
+        (like /api/texts/?group=).
+        Returns None if a slug doesn't match any text.
+        '''
+        ret = set()
+
+        for slug in group_slugs:
+            ids = AbstractedText.objects.filter(
+                Q(slug=slug) | Q(group__slug=slug) | Q(
+                    group__group__slug=slug
+                )
+            ).values_list('id', flat=True)
+            if not ids:
+                self.error('Group not found: {}'.format(slug))
+                return None
+            ret.update(ids)
+
+        return ret
+
+    def update_readings(self, text_ids=None):
+        '''
+        Rebuild the stored content_with_readings of the texts.
+        Must be called after any change to the content of the members.
+
+        text_ids: ids of the AbstractedTexts to rebuild, None for all.
+        Returns the number of texts rebuilt.
+        '''
+        encoded_texts = EncodedText.objects.filter(
+            abstracted_text__type__slug__in=['work', 'version']
+        ).select_related('abstracted_text__type')
+
+        if text_ids is not None:
+            encoded_texts = encoded_texts.filter(
+                abstracted_text_id__in=text_ids
+            )
+
+        ret = 0
+        for encoded_text in encoded_texts:
+            encoded_text.update_content_with_readings()
+            ret += 1
+
+        return ret
+
+    def import_records(self, get_records):
         '''
         Imports the text XML and metadata
-        from a json file exported from Archetype.
+        from the records of a json file exported from Archetype.
+
+        get_records: a function which returns an iterator over the records.
+        It is called at least twice: one pass to import the metadata,
+        another one to import the encoded texts by batch.
+        So only one batch of XML contents is in memory at any time.
 
         Insert or update.
         Stores archetype record id in .imported_id field
         to permanently keep track of the mapping.
-        '''
-        ab_types = AbstractedTextType.get_or_create_default_types()
-        statuses = {}
-        # see delete_unimported_records()
-        models_imported_ids = {m: [] for m in [
-            Repository, Manuscript, AbstractedText, EncodedText
-        ]}
 
-        # mapping from itempart id to abstracted text id
-        arch_ipid_to_ab_txt = {}
+        The incoming records are compared with the existing ones in memory,
+        then inserted/updated in bulk in a single transaction.
 
-        for jtcxml in data['results']:
-            self.log(jtcxml['str'], 2)
-            jtc = jtcxml['text_content']
-            jip = jtc['item_part']
-            jci = jip['current_item']
-            jrepo = jci['repository']
+        The texts which source content hasn't changed since the last import
+        are not processed again (unless --force).
 
-            if jip['type'] is None:
-                continue
-            ip_type = slugify(jip['type'])
+        Returns (parent_ids, text_ids), sets of AbstractedText ids.
+        parent_ids: groups which unique readings must be marked up again
+        text_ids: texts which readings must be rebuilt
+        '''
+        counts = Counter()
+        parent_ids = set()
+        text_ids = set()
 
-            status_name = jtcxml['status']['str']
-            status_slug = slugify(status_name)
-            status = statuses.get(status_slug, None)
-            if status is None:
-                status, _ = EncodedTextStatus.objects.get_or_create(
-                    slug=status_slug,
-                    defaults={'name': status_name}
+        with transaction.atomic():
+            with self.phase('metadata'):
+                values, statuses, encoded_types = \
+                    self.get_metadata_from_records(get_records())
+
+                repo_ids, _ = self.bulk_upsert(
+                    Repository, values[Repository], counts
                 )
-                statuses[status_slug] = status
 
-            if ip_type in ['manuscript']:
-                repo, _ = Repository.update_or_create(
-                    jrepo['id'], jrepo['place'], jrepo['str']
+                for ms in values[Manuscript].values():
+                    ms['repository_id'] = repo_ids[ms['repository_id']]
+                ms_ids, _ = self.bulk_upsert(
+                    Manuscript, values[Manuscript], counts
                 )
-                models_imported_ids[Repository].append(jrepo['id'])
-                ms, _ = Manuscript.update_or_create(
-                    jci['id'], repo, jci['shelfmark']
+
+                links = {}
+                for imported_id, ab_txt in values[AbstractedText].items():
+                    links[imported_id] = ab_txt.pop('group_id')
+                    if ab_txt['manuscript_id'] is not None:
+                        ab_txt['manuscript_id'] = ms_ids[
+                            ab_txt['manuscript_id']
+                        ]
+                ab_txt_ids, changed_ab_ids = self.bulk_upsert(
+                    AbstractedText, values[AbstractedText], counts
                 )
-                models_imported_ids[Manuscript].append(jci['id'])
-                ab_txt, _ = AbstractedText.update_or_create(
-                    jip['id'], ab_types[ip_type],
-                    manuscript=ms, locus=jip['locus']
+
+            with self.phase('links'):
+                # relationship among the abstracted texts
+                # ms-text -> version-text -> work-text
+                ab_txts = []
+                for ab_txt in AbstractedText.objects.filter(
+                    id__in=ab_txt_ids.values()
+                ).only('id', 'imported_id', 'group_id'):
+                    group_id = ab_txt_ids.get(links[ab_txt.imported_id], None)
+                    if ab_txt.group_id != group_id:
+                        parent_ids.update([ab_txt.group_id, group_id])
+                        ab_txt.group_id = group_id
+                        ab_txts.append(ab_txt)
+                self.bulk_update(AbstractedText, ab_txts, ['group_id'])
+
+            values[EncodedText], written, touched = self.import_texts(
+                get_records(), statuses, encoded_types, ab_txt_ids, counts
+            )
+
+            with self.phase('delete'):
+                models_imported_ids = {
+                    m: list(vs) for m, vs in values.items()
+                }
+                parent_ids.update(AbstractedText.objects.exclude(
+                    imported_id__in=models_imported_ids[AbstractedText]
+                ).values_list('group_id', flat=True))
+                parent_ids.update(EncodedText.objects.exclude(
+                    imported_id__in=models_imported_ids[EncodedText]
+                ).values_list('abstracted_text__group_id', flat=True))
+
+                deleted_count = self.delete_unimported_records(
+                    models_imported_ids
                 )
-                models_imported_ids[AbstractedText].append(jip['id'])
-            else:
-                ab_txt, _ = AbstractedText.update_or_create(
-                    jip['id'], ab_types[ip_type],
-                    name=jip['str'],
+
+            # the unique readings of a group depend on all its members
+            parent_ids.update(AbstractedText.objects.filter(
+                id__in=set(written.values()) | touched
+            ).values_list('group_id', flat=True))
+            parent_ids.discard(None)
+
+            with self.phase('heatmap'):
+                # the written texts are already up to date
+                EncodedText.update_region_readings(list(
+                    EncodedText.objects.filter(
+                        abstracted_text_id__in=touched | set(
+                            ab_txt.id for ab_txt in ab_txts
+                        )
+                    ).exclude(imported_id__in=written.keys())
+                ))
+
+            text_ids.update(written.values())
+            # the readings of a group depend on the content of its members
+            text_ids.update(parent_ids)
+            # e.g. a new siglum must appear in the readings of the group
+            text_ids.update(changed_ab_ids)
+            text_ids.update(AbstractedText.objects.filter(
+                id__in=changed_ab_ids
+            ).values_list('group_id', flat=True))
+            text_ids.discard(None)
+
+        self.log('{} inserted, {} updated, {} unchanged, {} deleted.'.format(
+            counts['inserted'], counts['updated'], counts['unchanged'],
+            deleted_count
+        ))
+        self.log('{} groups changed.'.format(len(parent_ids)))
+
+        return parent_ids, text_ids
+
+    def import_texts(
+        self, records, statuses, encoded_types, ab_txt_ids, counts
+    ):
+        '''
+        Insert or update the EncodedTexts from the Archetype records,
+        by batch. See import_records().
+
+        The content of a record is only cleaned and written if its hash
+        differs from the source_hash of the existing text (or --force).
+
+        Returns (imported_ids, written, touched)
+        imported_ids: the imported ids of all the records
+        written: {imported_id: abstracted_text_id} for all the texts
+            which content has been written
+        touched: AbstractedText ids of other texts which metadata changed
+        '''
+        imported_ids = []
+        written = {}
+        touched = set()
+
+        records = self.get_records_to_import(records)
+
+        select = None
+        if not self.force:
+            select = self.get_records_to_clean
+
+        for records, cleaned in self.get_cleaned_batches(
+            get_batches(records, self.BATCH_SIZE), select
+        ):
+            existing = self.get_existing_texts(records)
+
+            # records with a new content, records with the same content
+            text_values = [OrderedDict(), OrderedDict()]
+            for jtcxml, content_plain in zip(records, cleaned):
+                jtc = jtcxml['text_content']
+                imported_ids.append(jtc['id'])
+                old = existing.get(jtc['id'], None)
+
+                values = OrderedDict([
+                    ('status_id', statuses[jtcxml['status']['str']].id),
+                    ('type_id', encoded_types[jtc['type']].id),
+                    ('abstracted_text_id', ab_txt_ids[
+                        jtc['item_part']['id']
+                    ]),
+                ])
+                if old and list(values.values()) != old[:3]:
+                    # e.g. the text moved to another manuscript
+                    touched.update([
+                        old[2], values['abstracted_text_id']
+                    ])
+                values['source_hash'] = get_content_hash(jtcxml['content'])
+
+                if content_plain is not None:
+                    content, plain = content_plain
+                    content_hash = get_content_hash(content)
+                    if self.force or (
+                        old is None or content_hash != old[4]
+                    ):
+                        values.update([
+                            ('content', content),
+                            ('plain', plain),
+                            ('content_hash', content_hash),
+                        ])
+
+                text_values['content' not in values][jtc['id']] = values
+
+            with self.phase('texts: write'):
+                _, changed_ids = self.bulk_upsert(
+                    EncodedText, text_values[0], counts
                 )
-                models_imported_ids[AbstractedText].append(jip['id'])
+                self.bulk_upsert(EncodedText, text_values[1], counts)
 
-            EncodedText.update_or_create(
-                jtc['id'], ab_txt, jtc['type'],
-                self.clean_archetype_text_content(jtcxml['content']),
-                status
+            with self.phase('texts: indexes'):
+                changed_texts = list(
+                    EncodedText.objects.filter(id__in=changed_ids)
+                )
+                EncodedText.update_indexes(changed_texts)
+                for text in changed_texts:
+                    written[text.imported_id] = text.abstracted_text_id
+
+        return imported_ids, written, touched
+
+    def get_existing_texts(self, records):
+        '''
+        Returns {imported_id: [status_id, type_id, abstracted_text_id,
+        source_hash, content_hash]}
+        for the existing EncodedTexts of the Archetype records.
+        '''
+        return {
+            r[0]: list(r[1:])
+            for r in EncodedText.objects.filter(imported_id__in=[
+                jtcxml['text_content']['id'] for jtcxml in records
+            ]).values_list(
+                'imported_id', 'status_id', 'type_id', 'abstracted_text_id',
+                'source_hash', 'content_hash'
             )
-            models_imported_ids[EncodedText].append(jtc['id'])
+        }
 
-            arch_ipid_to_ab_txt[jip['id']] = ab_txt
+    def get_records_to_clean(self, records):
+        '''
+        Returns a list of booleans, one for each record,
+        True if its content has changed since the last import.
+        '''
+        existing = self.get_existing_texts(records)
 
-        # relationship among the abstracted texts
-        # ms-text -> version-text -> work-text
-        for jtcxml in data['results']:
-            jtc = jtcxml['text_content']
-            jip = jtc['item_part']
-            ab_text = arch_ipid_to_ab_txt.get(jip['id'], None)
-            if ab_text:
-                ab_text_group = arch_ipid_to_ab_txt.get(
-                    jip.get('group__id', None), None
+        return [
+            get_content_hash(jtcxml['content']) != existing.get(
+                jtcxml['text_content']['id'], [None] * 5
+            )[3]
+            for jtcxml in records
+        ]
+
+    def get_cleaned_batches(self, batches, select=None):
+        '''
+        Yields (records, [(cleaned content, plain text), ...])
+        for each batch of Archetype records in batches.
+
+        select: optional function which returns a list of booleans
+            for a batch of records, False to skip the cleaning of a record
+            (None is yielded instead of the cleaned content and text).
+
+        With --jobs N > 1 the contents are cleaned by a pool of N processes
+        and the next batch is cleaned while the current one is written.
+        The output is the same as in serial mode.
+        '''
+        def get_contents(records):
+            selected = select(records) if select else [True] * len(records)
+            return [
+                r['content'] if selected[i] else None
+                for i, r in enumerate(records)
+            ]
+
+        if self.jobs < 2:
+            for records in batches:
+                with self.phase('texts: clean'):
+                    cleaned = [
+                        get_clean_content_and_plain_text(content)
+                        for content in get_contents(records)
+                    ]
+                yield records, cleaned
+            return
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            pending = None
+            for records in batches:
+                # submit this batch before waiting for the previous one
+                cleaned = executor.map(
+                    get_clean_content_and_plain_text,
+                    get_contents(records),
+                    chunksize=max(1, len(records) // (self.jobs * 4))
                 )
-                ab_text.group = ab_text_group
-                ab_text.short_name = jip.get('group_locus', None)
-                ab_text.save()
+                if pending:
+                    yield self.wait_for_cleaned_batch(*pending)
+                pending = (records, cleaned)
+            if pending:
+                yield self.wait_for_cleaned_batch(*pending)
+
+    def wait_for_cleaned_batch(self, records, cleaned):
+        with self.phase('texts: clean'):
+            return records, list(cleaned)
+
+    def get_records_to_import(self, records):
+        '''Yields the Archetype records which can be imported'''
+        for jtcxml in records:
+            self.log(jtcxml['str'], 2)
+            if jtcxml['text_content']['item_part']['type'] is None:
+                continue
+            yield jtcxml
 
-        deleted_count = self.delete_unimported_records(models_imported_ids)
+    def get_metadata_from_records(self, records):
+        '''
+        Returns the field values of all the metadata records to import
+        from a list of Archetype text content records.
 
-        self.log('{} inserted/updated, {} deleted.'.format(
-            sum([len(ids) for m, ids in models_imported_ids.items()]),
-            deleted_count
-        ))
+        Returns (values, statuses, encoded_types)
+        values: {Model: {imported_id: {field_attname: value}}}
+        statuses: {status name: EncodedTextStatus}
+        encoded_types: {type name: EncodedTextType}
 
-        return True
+        Foreign keys among the imported models are set to the imported_id
+        of the related record.
+        '''
+        values = {m: OrderedDict() for m in [
+            Repository, Manuscript, AbstractedText
+        ]}
 
-    def clean_archetype_text_content(self, content):
-        # non-breaking spaces -> normal spaces
-        ret = (content or '').replace('&nbsp;', '').replace('\xA0', ' ')
+        ab_types = AbstractedTextType.get_or_create_default_types()
+        statuses = {}
+        encoded_types = {}
 
-        # allow the empty symbol to be styled
-        ret = ret.replace('∅', '<span class="no-text">∅</span>')
+        for jtcxml in self.get_records_to_import(records):
+            jtc = jtcxml['text_content']
+            jip = jtc['item_part']
+            jci = jip['current_item']
+            jrepo = jci['repository']
 
-        # ac-128: add an empty-region class the spans that only contains an
-        # empty symbol
-        import re
-        ret = re.sub(
-            r'(<span[^>]+data-dpt-type="unsettled"[^>]*)(>\s*∅\s*</span>)',
-            r'\1 class="empty-region"\2',
-            ret
-        )
+            ip_type = slugify(jip['type'])
 
-        # Minor XML transforms
-        xml = get_xml_from_unicode(ret, ishtml=True, add_root=True)
+            status_name = jtcxml['status']['str']
+            if status_name not in statuses:
+                status, _ = EncodedTextStatus.objects.get_or_create(
+                    slug=slugify(status_name),
+                    defaults={'name': status_name}
+                )
+                statuses[status_name] = status
 
-        counters = {
-            'version': 0,
-            'work': 0,
-        }
+            type_name = jtc['type']
+            if type_name not in encoded_types:
+                encoded_type, _ = EncodedTextType.objects.get_or_create(
+                    slug=slugify(type_name),
+                    defaults={'name': type_name}
+                )
+                encoded_types[type_name] = encoded_type
 
-        for region in xml.findall('.//span[@data-dpt-type="unsettled"]'):
-            # add data-dpt-group="version" to the v-regions
-            region_type = 'work'
-            if not region.attrib.get('data-dpt-group', None):
-                region_type = 'version'
-                region.attrib['data-dpt-group'] = region_type
-
-            # assign short id to all regions
-            counters[region_type] += 1
-            region.attrib['data-rid'] = '{}-{}'.format(
-                region_type[0], counters[region_type]
-            )
+            if ip_type in ['manuscript']:
+                repo = Repository.get_imported_values(
+                    jrepo['place'], jrepo['str']
+                )
+                values[Repository][jrepo['id']] = repo
+                values[Manuscript][jci['id']] = {
+                    'repository_id': jrepo['id'],
+                    'shelfmark': jci['shelfmark'],
+                }
+                ab_txt = AbstractedText.get_imported_values(
+                    ab_types[ip_type],
+                    manuscript=Manuscript(
+                        repository=Repository(**repo),
+                        shelfmark=jci['shelfmark']
+                    ),
+                    locus=jip['locus']
+                )
+                ab_txt['manuscript'] = jci['id']
+            else:
+                ab_txt = AbstractedText.get_imported_values(
+                    ab_types[ip_type], name=jip['str'],
+                )
+            values[AbstractedText][jip['id']] = {
+                'name': ab_txt['name'],
+                'slug': ab_txt['slug'],
+                'locus': ab_txt['locus'],
+                'type_id': ab_txt['type'].id,
+                'manuscript_id': ab_txt['manuscript'],
+                'short_name': jip.get('group_locus', None),
+                'group_id': jip.get('group__id', None),
+            }
+
+        return values, statuses, encoded_types
+
+    def bulk_upsert(self, model, values, counts):
+        '''
+        Insert or update the records of model in bulk
+        so they match values.
 
-        for sn in xml.findall('.//span[@data-dpt="sn"]'):
-            # add short if to all sentence number
-            sn.attrib['data-rid'] = 's-' + str(sn.text.strip())
+        values: {imported_id: {field_attname: value}}
+        counts: a Counter of inserted, updated and unchanged records
 
-        ret = get_unicode_from_xml(xml, remove_root=True)
+        Returns ({imported_id: id}, [id of inserted or updated records])
+        '''
+        if not values:
+            return {}, []
+
+        fields = list(next(iter(values.values())).keys())
+
+        existing = {}
+        for imported_ids in get_batches(values.keys(), self.BATCH_SIZE):
+            for r in model.objects.filter(
+                imported_id__in=imported_ids
+            ).only('id', 'imported_id', *fields):
+                existing[r.imported_id] = r
+
+        to_create = []
+        to_update = []
+        for imported_id, record_values in values.items():
+            record = existing.get(imported_id, None)
+            if record is None:
+                to_create.append(
+                    model(imported_id=imported_id, **record_values)
+                )
+                continue
+            changed = False
+            for field, value in record_values.items():
+                if getattr(record, field) != value:
+                    setattr(record, field, value)
+                    changed = True
+            if changed:
+                to_update.append(record)
+
+        model.objects.bulk_create(to_create)
+        self.bulk_update(model, to_update, fields)
+
+        counts['inserted'] += len(to_create)
+        counts['updated'] += len(to_update)
+        counts['unchanged'] += len(values) - len(to_create) - len(to_update)
+
+        # bulk_create doesn't return the ids on all the database backends
+        ids = {
+            imported_id: record.id
+            for imported_id, record in existing.items()
+        }
+        for imported_ids in get_batches(
+            [r.imported_id for r in to_create], self.BATCH_SIZE
+        ):
+            ids.update(model.objects.filter(
+                imported_id__in=imported_ids
+            ).values_list('imported_id', 'id'))
+
+        changed_ids = [r.id for r in to_update] + [
+            ids[r.imported_id] for r in to_create
+        ]
+
+        return ids, changed_ids
+
+    def bulk_update(self, model, records, fields):
+        '''bulk_update() which also sets the modification date'''
+        if hasattr(model, 'modified'):
+            now = timezone.now()
+            for record in records:
+                record.modified = now
+            fields = list(fields) + ['modified']
+
+        model.objects.bulk_update(records, fields)
+
+    @contextmanager
+    def phase(self, name):
+        '''Add the time spent in the enclosed block to the named phase'''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0) + time.time() - started
+            )
 
-        return ret
+    def log_timings(self):
+        '''Log the time spent in each phase, see phase()'''
+        for name, duration in self.timings.items():
+            self.log('{}: {:.2f}s'.format(name, duration), 2)
 
     def delete_unimported_records(self, models_imported_ids):
         '''
@@ -312,16 +1166,40 @@ ACTION:
   help
     show this help.
 
-  import FILE
+  import FILE [--jobs N] [--force] [--warm]
     import all the text content and metadata from FILE.
     update if the record already exists.
     FILE: a json file obtained from archetype API,
           see inline comment (handle_import)
+    records are compared with the DB and inserted/updated in bulk.
+    use -v 2 to show the time spent in each phase.
+    --jobs N: clean the contents with N processes.
+    only the texts which content has changed since the last import
+    are processed, with their groups; --force to process all of them.
 
   delete
     delete all the text concent records from the DB
 
-  unique
+  unique [--group SLUG] [--jobs N]
     mark up unique readings in all the texts
+    and rebuild the content with readings of all works and versions
+    --group SLUG: only the given work or version and the groups below it
+    --jobs N: process the groups with N processes.
+
+  warm [PATH ...] [--jobs N]
+    pre-populate the cache of the API responses:
+    list of texts, default requests of the search page (sentences and
+    heatmap), chunks of all the texts in all the views.
+    PATH: other API paths to request, e.g. comparative chunks
+          /api/texts/ID1,ID2/transcription/whole/whole/
+    --jobs N: N requests at a time.
+    Also available as a flag of import: import FILE --warm
+
+  bench highlight [QUERY ...]
+    time the highlighting of the search results in all the sentences
+
+  bench json [REPEAT]
+    time the json encoding of the list of texts and of the heatmap
+    with each encoder available (best of REPEAT, default 20).
 
 '''.format(self.help))
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0011_auto_20200420_1528'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encodedtext',
+            name='content_with_readings',
+            field=models.TextField(blank=True, help_text='Content with readings from members (works and versions)', null=True),
+        ),
+    ]
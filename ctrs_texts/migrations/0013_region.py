@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0012_encodedtext_content_with_readings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Region',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=20)),
+                ('ordinal', models.IntegerField()),
+                ('rid', models.CharField(blank=True, default='', max_length=20)),
+                ('element_id', models.CharField(blank=True, default='', max_length=100)),
+                ('copies', models.CharField(blank=True, default='0', max_length=20)),
+                ('reading', models.TextField(blank=True, default='')),
+                ('encoded_text', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='regions', to='ctrs_texts.EncodedText')),
+            ],
+            options={
+                'ordering': ['encoded_text', 'group', 'ordinal'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='region',
+            index=models.Index(fields=['encoded_text', 'group', 'ordinal'], name='ctrs_texts__encoded_255422_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:24
+
+from django.db import migrations
+from ctrs_texts.utils import get_regions_from_xml, get_xml_from_unicode
+
+
+def load_regions(apps, schema_editor):
+    EncodedText = apps.get_model('ctrs_texts', 'EncodedText')
+    Region = apps.get_model('ctrs_texts', 'Region')
+    for et in EncodedText.objects.all():
+        if not et.content:
+            continue
+        xml = get_xml_from_unicode(et.content, ishtml=True, add_root=True)
+        Region.objects.bulk_create([
+            Region(encoded_text=et, **region)
+            for region in get_regions_from_xml(xml)
+        ])
+
+
+def unload_regions(apps, schema_editor):
+    Region = apps.get_model('ctrs_texts', 'Region')
+    Region.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0013_region'),
+    ]
+
+    operations = [
+        migrations.RunPython(load_regions, reverse_code=unload_regions),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0014_load_regions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sentence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(blank=True, default='', max_length=20)),
+                ('ordinal', models.IntegerField()),
+                ('auxiliary', models.BooleanField(default=False)),
+                ('html', models.TextField(blank=True, default='')),
+                ('plain', models.TextField(blank=True, default='')),
+                ('encoded_text', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sentences', to='ctrs_texts.EncodedText')),
+            ],
+            options={
+                'ordering': ['encoded_text', 'ordinal'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='sentence',
+            index=models.Index(fields=['encoded_text', 'number'], name='ctrs_texts__encoded_9e71e1_idx'),
+        ),
+    ]
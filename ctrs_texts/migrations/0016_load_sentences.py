@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:41
+
+from django.db import migrations
+from ctrs_texts.utils import get_sentences_from_content
+
+
+def load_sentences(apps, schema_editor):
+    EncodedText = apps.get_model('ctrs_texts', 'EncodedText')
+    Sentence = apps.get_model('ctrs_texts', 'Sentence')
+    for et in EncodedText.objects.all():
+        Sentence.objects.bulk_create([
+            Sentence(encoded_text=et, **sentence)
+            for sentence in get_sentences_from_content(et.content)
+        ])
+
+
+def unload_sentences(apps, schema_editor):
+    Sentence = apps.get_model('ctrs_texts', 'Sentence')
+    Sentence.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0015_sentence'),
+    ]
+
+    operations = [
+        migrations.RunPython(load_sentences, reverse_code=unload_sentences),
+    ]
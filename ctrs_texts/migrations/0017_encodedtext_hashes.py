@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0016_load_sentences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encodedtext',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='encodedtext',
+            name='source_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
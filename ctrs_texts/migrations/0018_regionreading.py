@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0017_encodedtext_hashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionReading',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ordinal', models.IntegerField()),
+                ('reading', models.TextField(blank=True, default='')),
+                ('encoded_text', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='region_readings', to='ctrs_texts.EncodedText')),
+            ],
+            options={
+                'ordering': ['encoded_text', 'ordinal'],
+            },
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:40
+
+import copy
+
+from django.db import migrations
+from ctrs_texts.utils import get_xml_from_unicode, get_wregion_readings
+
+
+def load_region_readings(apps, schema_editor):
+    EncodedText = apps.get_model('ctrs_texts', 'EncodedText')
+    Region = apps.get_model('ctrs_texts', 'Region')
+    RegionReading = apps.get_model('ctrs_texts', 'RegionReading')
+
+    # {abstracted_text_id: parsed content of its transcription}
+    parents = {}
+
+    for et in EncodedText.objects.filter(
+        type__slug='transcription',
+        abstracted_text__type__slug='manuscript',
+    ).select_related('abstracted_text'):
+        group_id = et.abstracted_text.group_id
+        if group_id not in parents:
+            parent = EncodedText.objects.filter(
+                abstracted_text_id=group_id,
+                type__slug='transcription',
+            ).order_by('id').first()
+            parents[group_id] = None
+            if parent and parent.content:
+                parents[group_id] = get_xml_from_unicode(
+                    parent.content, ishtml=True, add_root=True
+                )
+        if parents[group_id] is None:
+            continue
+
+        vregions = list(Region.objects.filter(
+            encoded_text=et, group='version'
+        ).order_by('ordinal').values_list('reading', flat=True))
+
+        RegionReading.objects.bulk_create([
+            RegionReading(encoded_text=et, ordinal=ordinal, reading=reading)
+            for ordinal, reading in enumerate(get_wregion_readings(
+                copy.deepcopy(parents[group_id]), vregions
+            ))
+        ])
+
+
+def unload_region_readings(apps, schema_editor):
+    RegionReading = apps.get_model('ctrs_texts', 'RegionReading')
+    RegionReading.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0018_regionreading'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            load_region_readings, reverse_code=unload_region_readings
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:02
+
+from django.db import DatabaseError, migrations, transaction
+
+# trigram index for the regex searches on Sentence.plain,
+# see search.search_sentences() with CTRS_TEXTS_SEARCH_INDEX = False.
+# Optional: it needs the pg_trgm extension, which only a superuser
+# can install (CREATE EXTENSION pg_trgm). Without it the index is skipped,
+# the SQL below can be run once the extension has been installed.
+INDEX_NAME = 'ctrs_texts_sentence_plain_trgm'
+INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS {} ON ctrs_texts_sentence '
+    'USING gin (plain gin_trgm_ops)'.format(INDEX_NAME)
+)
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        installed = cursor.fetchone() is not None
+    if not installed:
+        try:
+            # in a savepoint, a failure doesn't abort the migration
+            with transaction.atomic(using=schema_editor.connection.alias):
+                schema_editor.execute('CREATE EXTENSION pg_trgm')
+        except DatabaseError as e:
+            print(
+                '\n  WARNING: {} not created, the pg_trgm extension '
+                'could not be installed ({}).\n  Ask a database superuser '
+                'to run CREATE EXTENSION pg_trgm; then run: {};'.format(
+                    INDEX_NAME, str(e).strip(), INDEX_SQL
+                )
+            )
+            return
+    schema_editor.execute(INDEX_SQL)
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0019_load_region_readings'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_trigram_index, reverse_code=drop_trigram_index
+        ),
+    ]
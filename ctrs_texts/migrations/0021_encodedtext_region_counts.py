@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:20
+
+import json
+
+from django.db import migrations, models
+from ctrs_texts.utils import get_xml_from_unicode, get_region_counts_from_xml
+
+
+def load_region_counts(apps, schema_editor):
+    EncodedText = apps.get_model('ctrs_texts', 'EncodedText')
+
+    for et in EncodedText.objects.exclude(content=None).exclude(content=''):
+        EncodedText.objects.filter(pk=et.pk).update(
+            region_counts=json.dumps(get_region_counts_from_xml(
+                get_xml_from_unicode(et.content, ishtml=True, add_root=True)
+            ), separators=(',', ':'))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0020_sentence_plain_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encodedtext',
+            name='region_counts',
+            field=models.TextField(blank=True, help_text='Number of unsettled regions per sentence (json)', null=True),
+        ),
+        migrations.RunPython(
+            load_region_counts, reverse_code=migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:05
+
+from django.db import migrations
+from ctrs_texts.utils import get_sentences_from_content
+
+
+def reload_sentences(apps, schema_editor):
+    # the paragraphs without sentence number are now indexed
+    EncodedText = apps.get_model('ctrs_texts', 'EncodedText')
+    Sentence = apps.get_model('ctrs_texts', 'Sentence')
+    Sentence.objects.all().delete()
+    for et in EncodedText.objects.all():
+        Sentence.objects.bulk_create([
+            Sentence(encoded_text=et, **sentence)
+            for sentence in get_sentences_from_content(et.content)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ctrs_texts', '0021_encodedtext_region_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            reload_sentences, reverse_code=migrations.RunPython.noop
+        ),
+    ]
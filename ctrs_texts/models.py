@@ -1,6 +1,9 @@
+import json
 import uuid
+from collections import OrderedDict
 
 from django.db import models
+from django.db.models import Q
 from django.utils.text import slugify
 from wagtail.search import index
 from wagtail.snippets.models import register_snippet
@@ -47,6 +50,25 @@ class EncodedText(index.Indexed, TimestampedModel, ImportedModel):
     plain = models.TextField(blank=True, null=True,
                              help_text='Content in plain text')
 
+    # sha1 of the content exported from Archetype, see ctrstxt import
+    source_hash = models.CharField(max_length=40, blank=True, null=True)
+    # sha1 of the imported content after cleaning,
+    # before the unique readings are marked up
+    content_hash = models.CharField(max_length=40, blank=True, null=True)
+
+    # json, the number of regions per sentence, see get_region_counts()
+    region_counts = models.TextField(
+        blank=True, null=True,
+        help_text='Number of unsettled regions per sentence (json)'
+    )
+
+    # The XML content with the variant readings of the members.
+    # Only for Work and Version texts, see get_content_with_readings().
+    content_with_readings = models.TextField(
+        blank=True, null=True,
+        help_text='Content with readings from members (works and versions)'
+    )
+
     abstracted_text = models.ForeignKey(
         'AbstractedText', blank=False, null=False,
         related_name='encoded_texts',
@@ -79,28 +101,303 @@ class EncodedText(index.Indexed, TimestampedModel, ImportedModel):
             self.abstracted_text, self.type, self.status
         )
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, update_readings=True, **kwargs):
+        '''
+        update_readings: False to leave the content_with_readings
+            of the related texts to the caller, e.g. a bulk update.
+        '''
         if self.content:
             self.plain = utils.get_plain_text(self)
 
         super().save(*args, **kwargs)
 
+        self.update_indexes([self])
+
+        if update_readings:
+            self.update_related_readings()
+
+        utils.bump_api_cache_version()
+
+    def delete(self, *args, update_readings=True, **kwargs):
+        ret = super().delete(*args, **kwargs)
+
+        if update_readings:
+            # the readings of this text in its parent
+            # and the region readings of its members
+            self.update_parent_readings()
+            self.update_region_readings([self])
+
+        utils.bump_api_cache_version()
+        return ret
+
+    @classmethod
+    def update_group_readings(cls, abstracted_text_ids):
+        '''
+        Rebuild the content_with_readings of the EncodedTexts of the given
+        AbstractedTexts and the RegionReadings of their members.
+        E.g. after a member has been renamed, moved or removed.
+        '''
+        encoded_texts = list(cls.objects.filter(
+            abstracted_text_id__in=[
+                text_id for text_id in abstracted_text_ids if text_id
+            ]
+        ).select_related('abstracted_text__type'))
+
+        for encoded_text in encoded_texts:
+            encoded_text.update_content_with_readings()
+
+        cls.update_region_readings(encoded_texts)
+
+    @classmethod
+    def update_indexes(cls, encoded_texts):
+        '''
+        Rebuild the Region and Sentence records extracted from the content
+        of the given EncodedTexts, and their region_counts.
+        Called by save(), call it after any bulk update of the content.
+        '''
+        for model in [Region, Sentence]:
+            records = []
+            for encoded_text in encoded_texts:
+                records.extend(model.get_records_from_text(encoded_text))
+
+            model.objects.filter(encoded_text__in=encoded_texts).delete()
+            model.objects.bulk_create(records)
+
+        changed = []
+        for encoded_text in encoded_texts:
+            region_counts = None
+            if encoded_text.content:
+                region_counts = json.dumps(
+                    utils.get_region_counts_from_xml(
+                        utils.get_xml_from_encoded_text(encoded_text)
+                    ), separators=(',', ':')
+                )
+            if region_counts != encoded_text.region_counts:
+                encoded_text.region_counts = region_counts
+                changed.append(encoded_text)
+        cls.objects.bulk_update(changed, ['region_counts'])
+
+        cls.update_region_readings(encoded_texts)
+
+    @classmethod
+    def update_region_readings(cls, encoded_texts):
+        '''
+        Rebuild the RegionReadings of the manuscript transcriptions
+        among the given EncodedTexts and among the members of the others.
+        Must be called after the Regions have been rebuilt.
+        '''
+        ids = set(encoded_text.abstracted_text_id
+                  for encoded_text in encoded_texts)
+        if not ids:
+            return
+
+        members = list(cls.objects.filter(
+            type__slug='transcription',
+            abstracted_text__type__slug='manuscript',
+        ).filter(
+            Q(abstracted_text_id__in=ids) | Q(
+                abstracted_text__group_id__in=ids
+            )
+        ).select_related('abstracted_text'))
+
+        parents = {}
+        for parent in cls.objects.filter(
+            type__slug='transcription',
+            abstracted_text_id__in=set(
+                member.abstracted_text.group_id for member in members
+            )
+        ).order_by('id'):
+            parents.setdefault(parent.abstracted_text_id, parent)
+
+        vregions = {}
+        for text_id, reading in Region.objects.filter(
+            encoded_text__in=members, group='version'
+        ).values_list('encoded_text_id', 'reading'):
+            vregions.setdefault(text_id, []).append(reading)
+
+        records = []
+        for member in members:
+            parent = parents.get(member.abstracted_text.group_id, None)
+            if parent is None or not parent.content:
+                continue
+            for ordinal, reading in enumerate(utils.get_wregion_readings(
+                utils.get_xml_from_encoded_text(parent, mutable=True),
+                vregions.get(member.id, []), member, parent
+            )):
+                records.append(RegionReading(
+                    encoded_text=member, ordinal=ordinal, reading=reading
+                ))
+
+        RegionReading.objects.filter(encoded_text__in=members).delete()
+        RegionReading.objects.bulk_create(records)
+
+    def update_related_readings(self):
+        '''
+        Rebuild the stored content_with_readings of this text
+        and of its parent (i.e. the text of the group this text belongs to).
+        '''
+        self.update_content_with_readings()
+        self.update_parent_readings()
+
+    def update_parent_readings(self):
+        '''
+        Rebuild the stored content_with_readings of the parent of this text
+        (i.e. the text of the group this text belongs to).
+        '''
+        group_id = self.abstracted_text.group_id
+        if group_id:
+            parent = EncodedText.objects.filter(
+                abstracted_text_id=group_id, type_id=self.type_id
+            ).select_related('abstracted_text__type').first()
+            if parent:
+                parent.update_content_with_readings()
+
+    def update_content_with_readings(self):
+        '''
+        Compute and store the content_with_readings of this text.
+        Does not call save() to avoid cascading updates.
+        '''
+        content = None
+        if self.abstracted_text.type.slug in ['work', 'version']:
+            content = self.compute_content_with_readings()
+
+        self.content_with_readings = content
+        EncodedText.objects.filter(pk=self.pk).update(
+            content_with_readings=content
+        )
+
+    def get_region_counts(self):
+        '''
+        Returns the number of unsettled regions of each group
+        in each sentence, see utils.get_region_counts_from_xml().
+        '''
+        if self.region_counts is not None:
+            return json.loads(self.region_counts)
+
+        return utils.get_region_counts_from_xml(
+            utils.get_xml_from_encoded_text(self)
+        )
+
     def get_content_with_readings(self):
         '''
         Returns XHTML content of this encoded text.
         Where each unsettled region contains the variant readings
         and associated metadata from participating members (MS or V).
+
+        Returns the stored version if available,
+        see update_content_with_readings().
+        '''
+        ret = self.content_with_readings
+        if ret is None:
+            ret = self.compute_content_with_readings()
+        return ret
+
+    @classmethod
+    def get_contents_with_readings(cls, encoded_texts):
+        '''
+        Returns {encoded_text.id: content with readings}
+        for each EncodedText in encoded_texts,
+        see get_content_with_readings().
+
+        The readings of the texts which content is not stored are
+        fetched together, see get_readings_from_members_bulk().
+        Select abstracted_text__type with the texts to avoid more queries.
+        '''
+        ret = {}
+
+        missing = []
+        for encoded_text in encoded_texts:
+            ret[encoded_text.id] = encoded_text.content_with_readings
+            if ret[encoded_text.id] is None:
+                missing.append(encoded_text)
+
+        readings = cls.get_readings_from_members_bulk(missing)
+        for encoded_text in missing:
+            regions, members, _ = readings.get(
+                encoded_text.id, ([], [], [])
+            )
+            ret[encoded_text.id] = encoded_text.compute_content_with_readings(
+                regions, members
+            )
+
+        return ret
+
+    @classmethod
+    def get_readings_tables(cls, encoded_texts):
+        '''
+        Returns {encoded_text.id: readings table} for each EncodedText
+        in encoded_texts, a compact alternative to the content with readings.
+        The readings of all the texts are fetched together,
+        see get_readings_from_members_bulk().
+        Select abstracted_text__type with the texts to avoid more queries.
+
+        readings table: {
+            'parent': siglum of the text,
+            'members': [{'id': AbstractedText id, 'siglum': ...}, ...],
+            'readings': [[reading, copies], ...], without duplicates,
+            'regions': [[index in readings or None if absent,
+                         one for each member], ...]
+        }
+        The regions are in the same order as the unsettled regions
+        of the group of the text (span[data-dpt-group="work|version"])
+        in its content. The table is empty for manuscripts.
+        '''
+        ret = {}
+
+        readings_from_members = cls.get_readings_from_members_bulk(
+            encoded_texts
+        )
+        for encoded_text in encoded_texts:
+            regions, members, _ = readings_from_members.get(
+                encoded_text.id, ([], [], [])
+            )
+
+            # {(reading, copies): index in readings}
+            indexes = OrderedDict()
+            table_regions = []
+            for region in regions:
+                row = []
+                for reading in region:
+                    if reading.get('absent', False):
+                        # the member has no reading for that region
+                        row.append(None)
+                        continue
+                    key = (reading['reading'], reading['copies'])
+                    row.append(indexes.setdefault(key, len(indexes)))
+                table_regions.append(row)
+
+            ret[encoded_text.id] = OrderedDict([
+                ['parent', encoded_text.abstracted_text.short_name],
+                ['members', [
+                    OrderedDict([
+                        ['id', member.id],
+                        ['siglum', member.short_name],
+                    ])
+                    for member in members
+                ]],
+                ['readings', [list(key) for key in indexes.keys()]],
+                ['regions', table_regions],
+            ])
+
+        return ret
+
+    def compute_content_with_readings(self, regions=None, members=None):
+        '''
+        Returns XHTML content of this encoded text with the readings.
+        See get_content_with_readings().
+        regions, members: as returned by get_readings_from_members(),
+            fetched if not provided.
         '''
         abstracted_type = self.abstracted_text.type
 
         if abstracted_type.slug == 'manuscript':
             return self.content
 
-        regions, members = self.get_readings_from_members()
+        if regions is None:
+            regions, members = self.get_readings_from_members()
 
         #  Get the content of the parent (i.e. self)
-        xml = utils.get_xml_from_unicode(
-            self.content, ishtml=True, add_root=True)
+        xml = utils.get_xml_from_encoded_text(self, mutable=True)
         ri = 0
 
         # Now inject the region content and info into each region of the parent
@@ -165,65 +462,115 @@ class EncodedText(index.Indexed, TimestampedModel, ImportedModel):
         members: a list of m members
         member: an AbstractedText that belongs to the group formed by this text
         '''
-        regions = []
-        members = []
-        abstracted_type = self.abstracted_text.type
+        regions, members, _ = self.get_readings_from_members_bulk(
+            [self]
+        ).get(self.id, ([], [], []))
 
-        if abstracted_type.slug == 'manuscript':
-            return regions, members
+        return regions, members
 
-        ab_text = self.abstracted_text
-        members = list(ab_text.members.all().exclude(
-            short_name__in=['HM1', 'HM2']
-        ))
+    @classmethod
+    def get_readings_from_members_bulk(cls, parents):
+        '''
+        Returns {parent.id: (regions, members, member_texts)}
+        for each EncodedText in parents.
+        See get_readings_from_members() for regions and members.
+        member_texts: a list of m EncodedText (or None), one for each member
+
+        Fetches all the members, their encoded texts and their regions
+        in three queries, regardless of the number of parents and members.
+        Select abstracted_text__type with the parents to avoid more queries.
+        '''
+        ret = {}
 
-        #  Collate all the regions from all the members
-        regions = []
-        for mi, member in enumerate(members):
-            other_content = member.encoded_texts.filter(type=self.type).first()
+        parents = [
+            parent for parent in parents
+            if parent.abstracted_text.type.slug != 'manuscript'
+        ]
 
-            if not other_content:
-                continue
-            for ri, region in enumerate(other_content.get_regions(
-                abstracted_type.slug)
+        members_by_group = {
+            parent.abstracted_text_id: [] for parent in parents
+        }
+        if members_by_group:
+            for member in AbstractedText.objects.filter(
+                group_id__in=members_by_group.keys()
+            ).exclude(
+                short_name__in=['HM1', 'HM2']
             ):
-                if len(regions) <= ri:
-                    # watch out: the SAME dictionary instance is shared by all
-                    # entries by default. You modify one => all are modified!
-                    regions.append([
-                        {
-                            'parent': 'ms',
-                            'reading': '[absent]',
-                            'id': '',
-                            'copies': '0',
-                        }
-                    ] * len(members))
-
-                regions[ri][mi] = region
-                region['parent'] = ab_text.short_name
+                members_by_group[member.group_id].append(member)
+
+        # {(abstracted_text_id, type_id): encoded_text}
+        member_texts = {}
+        member_ids = [
+            member.id
+            for members in members_by_group.values()
+            for member in members
+        ]
+        if member_ids:
+            for text in cls.objects.filter(
+                abstracted_text_id__in=member_ids,
+                type_id__in=set(parent.type_id for parent in parents)
+            ).order_by('id'):
+                member_texts.setdefault(
+                    (text.abstracted_text_id, text.type_id), text
+                )
 
-        return regions, members
+        # {(encoded_text_id, group): [region, ...]}
+        member_regions = {}
+        if member_texts:
+            for region in Region.objects.filter(
+                encoded_text_id__in=[t.id for t in member_texts.values()],
+                group__in=set(p.abstracted_text.type.slug for p in parents)
+            ):
+                member_regions.setdefault(
+                    (region.encoded_text_id, region.group), []
+                ).append(region.as_dict())
+
+        for parent in parents:
+            ab_text = parent.abstracted_text
+            members = members_by_group[ab_text.id]
+            texts = [
+                member_texts.get((member.id, parent.type_id), None)
+                for member in members
+            ]
+
+            #  Collate all the regions from all the members
+            regions = []
+            for mi, other_content in enumerate(texts):
+                if not other_content:
+                    continue
+                for ri, region in enumerate(member_regions.get(
+                    (other_content.id, ab_text.type.slug), [])
+                ):
+                    if len(regions) <= ri:
+                        # watch out: the SAME dictionary instance is shared by
+                        # all entries by default.
+                        # You modify one => all are modified!
+                        regions.append([
+                            {
+                                'parent': 'ms',
+                                'reading': '[absent]',
+                                'id': '',
+                                'copies': '0',
+                                'absent': True,
+                            }
+                        ] * len(members))
+
+                    regions[ri][mi] = region
+                    region['parent'] = ab_text.short_name
+
+            ret[parent.id] = (regions, members, texts)
+
+        return ret
 
     def get_regions(self, region_type):
         '''
         Returns a list of unsettled regions (of type region_type=work|version)
         with their plain text reading extracted from this text ONLY.
         '''
-        ret = []
-
-        xml = utils.get_xml_from_unicode(
-            self.content, ishtml=True, add_root=True)
-
-        # for region in xml.findall('.//span[@data-dpt-type="unsettled"]'):
-        region_selector = './/span[@data-dpt-group="' + region_type + '"]'
-        for region in xml.findall(region_selector):
-            ret.append({
-                'reading': utils.get_unicode_from_xml(region, text_only=True),
-                'id': region.attrib.get('id', ''),
-                'copies': region.attrib.get('data-copies', '0'),
-            })
-
-        return ret
+        return [
+            region.as_dict()
+            for region in self.regions.filter(group=region_type)
+        ]
 
     search_fields = [
         index.RelatedFields('abstracted_text', [
@@ -232,6 +579,130 @@ class EncodedText(index.Indexed, TimestampedModel, ImportedModel):
     ]
 
 
+class Region(models.Model):
+    '''
+    An unsettled region of an EncodedText.
+    Extracted from the content each time the text is saved,
+    see EncodedText.update_indexes().
+    '''
+    encoded_text = models.ForeignKey(
+        'EncodedText', blank=False, null=False,
+        related_name='regions',
+        on_delete=models.CASCADE
+    )
+    # work or version (data-dpt-group)
+    group = models.CharField(max_length=20)
+    # position among the regions of the same group in the text, from 0
+    ordinal = models.IntegerField()
+    # short id, e.g. w-12 (data-rid)
+    rid = models.CharField(max_length=20, blank=True, default='')
+    # id of the region element
+    element_id = models.CharField(max_length=100, blank=True, default='')
+    copies = models.CharField(max_length=20, blank=True, default='0')
+    # plain text reading
+    reading = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['encoded_text', 'group', 'ordinal']
+        indexes = [
+            models.Index(fields=['encoded_text', 'group', 'ordinal']),
+        ]
+
+    def __str__(self):
+        return '{} ({})'.format(self.rid, self.encoded_text_id)
+
+    def as_dict(self):
+        '''
+        Returns a dictionary with the reading, id and copies of the region.
+        See EncodedText.get_regions().
+        '''
+        return {
+            'reading': self.reading,
+            'id': self.element_id,
+            'copies': self.copies,
+        }
+
+    @classmethod
+    def get_records_from_text(cls, encoded_text):
+        '''Returns a list of unsaved Regions extracted from encoded_text'''
+        if not encoded_text.content:
+            return []
+
+        return [
+            cls(encoded_text=encoded_text, **region)
+            for region in utils.get_regions_from_xml(
+                utils.get_xml_from_encoded_text(encoded_text)
+            )
+        ]
+
+
+class RegionReading(models.Model):
+    '''
+    The plain text reading of a w-region in a manuscript, i.e. the w-region
+    of its parent where all the v-regions have been substituted
+    with the readings of the manuscript. Used by the heatmap.
+    Rebuilt each time the manuscript or its parent is saved,
+    and when they are moved to another group or deleted,
+    see EncodedText.update_region_readings().
+    '''
+    encoded_text = models.ForeignKey(
+        'EncodedText', blank=False, null=False,
+        related_name='region_readings',
+        on_delete=models.CASCADE
+    )
+    # position among the w-regions of the parent, from 0
+    ordinal = models.IntegerField()
+    # plain text reading
+    reading = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['encoded_text', 'ordinal']
+
+    def __str__(self):
+        return '{} ({})'.format(self.ordinal, self.encoded_text_id)
+
+
+class Sentence(models.Model):
+    '''
+    A numbered sentence, the paragraphs before the first number
+    or an auxiliary paragraph of an EncodedText.
+    Extracted from the content each time the text is saved,
+    see EncodedText.update_indexes().
+    '''
+    encoded_text = models.ForeignKey(
+        'EncodedText', blank=False, null=False,
+        related_name='sentences',
+        on_delete=models.CASCADE
+    )
+    # e.g. '12' (data-rid="s-12"), blank if no number
+    number = models.CharField(max_length=20, blank=True, default='')
+    # position in the text, from 0
+    ordinal = models.IntegerField()
+    # ac-139 auxiliary paragraphs are not part of the numbered sentences
+    auxiliary = models.BooleanField(default=False)
+    html = models.TextField(blank=True, default='')
+    plain = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['encoded_text', 'ordinal']
+        indexes = [
+            models.Index(fields=['encoded_text', 'number']),
+        ]
+
+    def __str__(self):
+        return '{} ({})'.format(self.number, self.encoded_text_id)
+
+    @classmethod
+    def get_records_from_text(cls, encoded_text):
+        '''Returns a list of unsaved Sentences extracted from encoded_text'''
+        return [
+            cls(encoded_text=encoded_text, **sentence)
+            for sentence in utils.get_sentences_from_content(
+                encoded_text.content
+            )
+        ]
+
+
 @register_snippet
 class Repository(NamedModel, ImportedModel):
     city = models.CharField(max_length=200, null=False, blank=False)
@@ -240,14 +711,19 @@ class Repository(NamedModel, ImportedModel):
     def update_or_create(cls, imported_id, place, name):
         rec, created = cls.objects.update_or_create(
             imported_id=imported_id,
-            defaults={
-                'slug': slugify('{}-{}'.format(place, name)),
-                'city': place, 'name': name,
-            }
+            defaults=cls.get_imported_values(place, name)
         )
 
         return rec, created
 
+    @classmethod
+    def get_imported_values(cls, place, name):
+        '''Returns the field values of an imported repository'''
+        return {
+            'slug': slugify('{}-{}'.format(place, name)),
+            'city': place, 'name': name,
+        }
+
     class Meta:
         verbose_name_plural = 'Repositories'
 
@@ -322,6 +798,43 @@ class AbstractedText(NamedModel, ImportedModel):
         on_delete=models.SET_NULL
     )
 
+    def save(self, *args, update_readings=True, **kwargs):
+        '''
+        update_readings: see EncodedText.save()
+        '''
+        # (group, siglum) before the change
+        previous = AbstractedText.objects.filter(pk=self.pk).values_list(
+            'group_id', 'short_name'
+        ).first() if self.pk else None
+
+        super().save(*args, **kwargs)
+
+        if update_readings and previous and \
+                previous != (self.group_id, self.short_name):
+            # the readings of this text are shown in its group
+            # with its siglum, those of its members with its own
+            EncodedText.update_group_readings([
+                self.id, self.group_id, previous[0]
+            ])
+
+        utils.bump_api_cache_version()
+
+    def delete(self, *args, update_readings=True, **kwargs):
+        # the members are removed from the group (SET_NULL)
+        text_ids = [self.group_id] + list(
+            self.members.values_list('id', flat=True)
+        )
+
+        ret = super().delete(*args, **kwargs)
+
+        if update_readings:
+            # the readings of the group without this text
+            # and of the former members without it
+            EncodedText.update_group_readings(text_ids)
+
+        utils.bump_api_cache_version()
+        return ret
+
     def get_status(self):
         ret = None
         transc = self.encoded_texts.filter(
@@ -334,6 +847,17 @@ class AbstractedText(NamedModel, ImportedModel):
     def update_or_create(
         cls, imported_id, type, name=None, manuscript=None, locus=None
     ):
+        return cls.objects.update_or_create(
+            imported_id=imported_id,
+            defaults=cls.get_imported_values(type, name, manuscript, locus)
+        )
+
+    @classmethod
+    def get_imported_values(cls, type, name=None, manuscript=None, locus=None):
+        '''
+        Returns the field values of an imported text.
+        The name of a MS text is derived from the manuscript and locus.
+        '''
         assert manuscript or name
 
         if name is None:
@@ -341,7 +865,7 @@ class AbstractedText(NamedModel, ImportedModel):
             if locus:
                 name += ', ' + locus
 
-        defaults = {
+        return {
             'name': name,
             'type': type,
             'locus': locus,
@@ -349,11 +873,6 @@ class AbstractedText(NamedModel, ImportedModel):
             'slug': slugify(name),
         }
 
-        return cls.objects.update_or_create(
-            imported_id=imported_id,
-            defaults=defaults
-        )
-
     def __str__(self):
         return '{} ({})'.format(self.name, self.type)
 
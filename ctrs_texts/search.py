@@ -0,0 +1,261 @@
+'''
+Sentence-level text search.
+
+The sentences of all the texts are indexed in memory (SentenceIndex):
+an inverted index of their words, looked up by prefix.
+The index is rebuilt when the corpus changes, see utils.get_corpus_version().
+'''
+import base64
+import bisect
+import re
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from . import utils
+
+WORD_PATTERN = re.compile(r'\w+')
+
+# the words beginning with a query word, see get_highlight_pattern()
+WORD_PREFIX_PATTERN = r'\b{}\w*\b'
+
+# maximum number of results per page, see get_page_size()
+PAGE_SIZE_MAX = 1000
+
+
+def get_page_size():
+    '''
+    Returns the default number of results per page
+    (settings.CTRS_TEXTS_SEARCH_PAGE_SIZE).
+    '''
+    return getattr(settings, 'CTRS_TEXTS_SEARCH_PAGE_SIZE', 100)
+
+
+def get_cursor(offset):
+    '''Returns an opaque cursor pointing to the result at offset'''
+    return base64.urlsafe_b64encode(
+        'o:{}'.format(offset).encode('ascii')
+    ).decode('ascii')
+
+
+def get_offset_from_cursor(cursor):
+    '''
+    Returns the offset of a cursor, see get_cursor().
+    Raises ValueError if the cursor is invalid.
+    '''
+    try:
+        ret = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        ret = int(ret[2:]) if ret.startswith('o:') else -1
+    except (ValueError, UnicodeError):
+        ret = -1
+
+    if ret < 0:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+    return ret
+
+
+def get_words(text):
+    '''Returns the list of lowercase words in text'''
+    return WORD_PATTERN.findall((text or '').lower())
+
+
+def get_highlight_pattern(query):
+    '''
+    Returns a compiled regex which matches the words beginning with
+    any word of the query, None if the query is empty.
+    See utils.highlight_html().
+    '''
+    # the same words as the search, see SentenceIndex.search()
+    words = get_words(query)
+    if not words:
+        return None
+
+    return re.compile('({})'.format('|'.join([
+        WORD_PREFIX_PATTERN.format(re.escape(word)) for word in words
+    ])), re.I)
+
+
+class SentenceIndex:
+    '''
+    In-memory inverted index of the words of all the Sentences.
+
+    self.sentences: one (sentence id, abstracted text id, encoded type slug)
+        per sentence, in the order of the texts
+        (group short name, short name) then of the sentences in the text.
+    self.words: the sorted list of all the distinct words
+    self.postings: {word: {sentence position: occurrences}}
+    '''
+
+    def __init__(self, version=None):
+        self.version = version
+        self.sentences = []
+        self.words = []
+        self.postings = {}
+
+    @classmethod
+    def build(cls, version=None):
+        from .models import Sentence
+
+        ret = cls(version)
+
+        for sentence_id, ab_text_id, type_slug, plain in \
+                Sentence.objects.order_by(
+                    'encoded_text__abstracted_text__group__short_name',
+                    'encoded_text__abstracted_text__short_name',
+                    'encoded_text_id',
+                    'ordinal'
+                ).values_list(
+                    'id', 'encoded_text__abstracted_text_id',
+                    'encoded_text__type__slug', 'plain'
+                ):
+            position = len(ret.sentences)
+            ret.sentences.append((sentence_id, ab_text_id, type_slug))
+            for word, count in Counter(get_words(plain)).items():
+                ret.postings.setdefault(word, {})[position] = count
+
+        ret.words = sorted(ret.postings.keys())
+
+        return ret
+
+    def get_prefix_postings(self, prefix):
+        '''
+        Returns {sentence position: occurrences} for all the words
+        beginning with prefix.
+        '''
+        ret = Counter()
+
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            ret.update(self.postings[self.words[i]])
+            i += 1
+
+        return ret
+
+    def search(self, query, encoding_type='transcription', text_ids=None,
+               order='rank', offset=0, limit=None):
+        '''
+        Returns (total, [sentence id, ...]) for the sentences which contain
+        a word beginning with each word of the query.
+
+        encoding_type: slug of the EncodedTextType of the sentences
+        text_ids: optional list of AbstractedText ids
+        order: 'rank' for the sentences with the most occurrences of the
+            query words first, 'text' for the order of the texts.
+        offset, limit: the slice of the results to return,
+            total is the number of results before slicing.
+        An empty query matches all the sentences,
+        a query without any word (e.g. '-') matches none.
+        '''
+        if text_ids is not None:
+            text_ids = set(int(text_id) for text_id in text_ids)
+
+        scores = None
+        for term in get_words(query):
+            postings = self.get_prefix_postings(term)
+            if scores is None:
+                scores = postings
+            else:
+                # AND: only keep the sentences matching all the terms
+                scores = Counter({
+                    position: count + postings[position]
+                    for position, count in scores.items()
+                    if position in postings
+                })
+            if not scores:
+                break
+
+        if scores is None and (query or '').strip():
+            return 0, []
+
+        if scores is None:
+            positions = range(len(self.sentences))
+            scores = {}
+        else:
+            positions = sorted(scores.keys())
+
+        positions = [
+            position for position in positions
+            if self.sentences[position][2] == encoding_type and (
+                text_ids is None or self.sentences[position][1] in text_ids
+            )
+        ]
+
+        if order == 'rank':
+            positions.sort(key=lambda position: -scores.get(position, 0))
+
+        end = None if limit is None else offset + limit
+
+        return len(positions), [
+            self.sentences[position][0] for position in positions[offset:end]
+        ]
+
+
+# the current SentenceIndex, see get_sentence_index()
+sentence_index = None
+sentence_index_lock = threading.Lock()
+
+
+def get_sentence_index(version=None):
+    '''
+    Returns the SentenceIndex of the current version of the corpus.
+    It is built on the first call and rebuilt after any change.
+    version: the current version if already known,
+        see utils.get_corpus_version().
+    '''
+    global sentence_index
+
+    if version is None:
+        version = utils.get_corpus_version()
+
+    ret = sentence_index
+    if ret is None or ret.version != version:
+        with sentence_index_lock:
+            ret = sentence_index
+            if ret is None or ret.version != version:
+                ret = sentence_index = SentenceIndex.build(version)
+
+    return ret
+
+
+def search_sentences(query, encoding_type='transcription', text_ids=None,
+                     order='rank', offset=0, limit=None, version=None):
+    '''
+    Returns (total, [sentence id, ...]), see SentenceIndex.search().
+    version: see get_sentence_index().
+
+    With settings.CTRS_TEXTS_SEARCH_INDEX = False the sentences are
+    searched in the database (see utils.get_db_search_pattern())
+    rather than in the memory index.
+    '''
+    if getattr(settings, 'CTRS_TEXTS_SEARCH_INDEX', True):
+        return get_sentence_index(version).search(
+            query, encoding_type, text_ids, order, offset, limit
+        )
+
+    from .models import Sentence
+
+    if (query or '').strip() and not get_words(query):
+        return 0, []
+
+    hits = Sentence.objects.filter(encoded_text__type__slug=encoding_type)
+
+    if text_ids is not None:
+        hits = hits.filter(encoded_text__abstracted_text_id__in=text_ids)
+
+    # AND: one filter per term
+    for term in get_words(query):
+        hits = hits.filter(plain__iregex=utils.get_db_search_pattern(term))
+
+    # the occurrences are not counted in the database, no ranking
+    hits = hits.order_by(
+        'encoded_text__abstracted_text__group__short_name',
+        'encoded_text__abstracted_text__short_name',
+        'encoded_text_id',
+        'ordinal'
+    ).values_list('id', flat=True)
+
+    end = None if limit is None else offset + limit
+
+    return hits.count(), list(hits[offset:end])
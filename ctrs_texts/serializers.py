@@ -0,0 +1,127 @@
+'''
+JSON encoding of the API responses.
+
+orjson is used if it is installed (much faster), the json module otherwise.
+Set settings.CTRS_TEXTS_JSON_ENCODER = 'json' to always use the json module.
+'''
+import json
+from collections.abc import Iterator
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+django_json_encoder = DjangoJSONEncoder()
+
+
+def encode_with_json(value):
+    return json.dumps(value, cls=DjangoJSONEncoder).encode('utf-8')
+
+
+def encode_with_orjson(value):
+    # same types as DjangoJSONEncoder (dates, decimals, lazy strings, ...)
+    return orjson.dumps(
+        value, default=django_json_encoder.default,
+        option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    )
+
+
+# {name: (encode function, item separator, key separator)}
+ENCODERS = {
+    'json': (encode_with_json, ', ', ': '),
+    'orjson': (encode_with_orjson, ',', ':'),
+}
+
+
+def get_encoder_names():
+    '''Returns the names of the encoders available, the fastest first'''
+    return [name for name in ['orjson', 'json'] if name != 'orjson' or orjson]
+
+
+def get_encoder_name():
+    '''
+    Returns the name of the encoder to use:
+    settings.CTRS_TEXTS_JSON_ENCODER if available, otherwise the fastest.
+    '''
+    names = get_encoder_names()
+    ret = getattr(settings, 'CTRS_TEXTS_JSON_ENCODER', None)
+    if ret not in names:
+        ret = names[0]
+    return ret
+
+
+def encode(value, encoder=None):
+    '''
+    Returns value encoded in json, as utf-8 bytes.
+    encoder: the name of the encoder, see get_encoder_name().
+    '''
+    return ENCODERS[encoder or get_encoder_name()][0](value)
+
+
+def dumps(value, encoder=None):
+    '''Returns value encoded in json, as a string. See encode().'''
+    return encode(value, encoder).decode('utf-8')
+
+
+class JSONFragment(str):
+    '''A string of already encoded json, see iter_json()'''
+
+
+# the depth of the iterators and JSONFragments iter_json() looks for,
+# e.g. {'data': [{'regions': <generator>}]}
+STREAMED_DEPTH = 3
+
+
+def is_streamed(value, depth=STREAMED_DEPTH):
+    '''
+    Returns True if iter_json() has to walk through value
+    rather than encode it at once.
+    '''
+    if isinstance(value, (JSONFragment, Iterator)):
+        return True
+    if depth > 0:
+        if isinstance(value, dict):
+            return any(is_streamed(v, depth - 1) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return any(is_streamed(v, depth - 1) for v in value)
+    return False
+
+
+def iter_json(value, encoder=None, depth=STREAMED_DEPTH):
+    '''
+    Yields the json encoding of value piece by piece.
+    Same output as dumps(value)
+    except that the iterators (e.g. generators) are encoded as lists
+    one item at a time, and the JSONFragments are copied as they are.
+    The dicts and lists which contain neither (up to depth levels below)
+    are encoded at once.
+    '''
+    encoder = encoder or get_encoder_name()
+    _, item_separator, key_separator = ENCODERS[encoder]
+
+    if isinstance(value, JSONFragment):
+        yield value
+    elif isinstance(value, Iterator) or (
+        isinstance(value, (list, tuple)) and is_streamed(value, depth)
+    ):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield item_separator
+            yield from iter_json(item, encoder, depth - 1)
+        yield ']'
+    elif isinstance(value, dict) and is_streamed(value, depth):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield '{}{}{}'.format(
+                item_separator if i else '', dumps(str(key), encoder),
+                key_separator
+            )
+            yield from iter_json(item, encoder, depth - 1)
+        yield '}'
+    else:
+        yield dumps(value, encoder)
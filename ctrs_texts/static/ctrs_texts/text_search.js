@@ -190,6 +190,24 @@ $(() => {
           })
       },
 
+      fetch_more_results: function () {
+        // append the next page of results (see links.next)
+        if (this.status == STATUS_FETCHING) return
+
+        this.status = STATUS_FETCHING
+        let self = this
+
+        $.getJSON(self.response.links.next)
+          .done((res) => {
+            self.status = STATUS_FETCHED
+            self.response.data.push(...res.data)
+            Vue.set(self.response, 'links', res.links)
+          })
+          .fail((res) => {
+            self.status = STATUS_ERROR
+          })
+      },
+
       get_text_from_id_or_siglum: function (id_or_siglum) {
         id_or_siglum += ''
         for (let text of this.facets.texts) {
@@ -100,14 +100,19 @@ $(() => {
         handler: function () {
           // Something has changed in a block or view,
           // fetch view content if needed.
-          let qs = ''
+          // {view_type: [[block, view], ...]}
+          let pending = {}
           for (let block of this.blocks) {
             for (let view of block.views) {
               if (view.status === STATUS_TO_FETCH) {
-                this.on_view_changed(block, view)
+                pending[view.type] = pending[view.type] || []
+                pending[view.type].push([block, view])
               }
             }
           }
+          for (let view_type of Object.keys(pending)) {
+            this.fetch_views(view_type, pending[view_type])
+          }
           this.update_query_string()
         },
         deep: true,
@@ -134,25 +139,52 @@ $(() => {
 
       on_view_changed: function (block, view) {
         // a view needs its content to be fetched
-        view.status = STATUS_FETCHING
+        this.fetch_views(view.type, [[block, view]])
+      },
+
+      fetch_views: function (view_type, block_views) {
+        // fetch the content of views of the same type
+        // with a single (comparative) request for all their texts
         let self = this
+        let text_ids = []
+        for (let [block, view] of block_views) {
+          view.status = STATUS_FETCHING
+          if (!text_ids.includes(block.text.id)) {
+            text_ids.push(block.text.id)
+          }
+        }
         $.getJSON(
-          '/api/texts/' + block.text.id + '/' + view.type + '/whole/whole/'
+          '/api/texts/' + text_ids.join(',') + '/' + view_type + '/whole/whole/'
         )
           .done((res) => {
-            for (const k of Object.keys(res.data.attributes)) {
-              Vue.set(view, k, res.data.attributes[k])
+            // {text id: chunk}
+            let chunks = {}
+            for (let chunk of text_ids.length > 1 ? res.data : [res.data]) {
+              if (chunk.relationships) {
+                chunks[chunk.relationships.text.data.id] = chunk
+              }
             }
-            // view.chunk = res.data.attributes.chunk;
-            view.status = STATUS_FETCHED
+            for (let [block, view] of block_views) {
+              let chunk = chunks[block.text.id]
+              if (!chunk || !chunk.attributes) {
+                view.status = STATUS_ERROR
+                continue
+              }
+              for (const k of Object.keys(chunk.attributes)) {
+                Vue.set(view, k, chunk.attributes[k])
+              }
+              view.status = STATUS_FETCHED
 
-            // add javascript interactions to the text chunk
-            Vue.nextTick(function () {
-              self._after_chunk_loaded(block, view)
-            })
+              // add javascript interactions to the text chunk
+              Vue.nextTick(function () {
+                self._after_chunk_loaded(block, view)
+              })
+            }
           })
           .fail((res) => {
-            view.status = STATUS_ERROR
+            for (let [block, view] of block_views) {
+              view.status = STATUS_ERROR
+            }
           })
       },
 
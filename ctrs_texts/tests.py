@@ -1,7 +1,22 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.core.cache import cache
 from django.core.management import call_command
-from ctrs_texts.models import EncodedText
-from . import utils
+from ctrs_texts.models import (
+    AbstractedText, EncodedText, RegionReading, Sentence
+)
+from . import search, serializers, utils
+from .management.commands import ctrstxt
 
 ARC_TEXT_JSON_PATH = 'arc-content.json'
 
@@ -40,6 +55,10 @@ class TextTestCase(TestCase):
             for sentence_number in range(1, 28):
                 sentence_count += 1
                 sentence = utils.get_sentence_from_text(et, sentence_number)
+                stored = et.sentences.filter(
+                    number=sentence_number, auxiliary=False
+                ).first()
+                self.assertEqual(stored.html if stored else '', sentence)
                 if not sentence:
                     empty_sentences.append(sentence_number)
                     empty_sentence_count += 1
@@ -54,3 +73,767 @@ class TextTestCase(TestCase):
         )
 
         self.assertEqual(empty_sentence_count, 0)
+
+    def test_readings_from_members_queries(self):
+        '''Members readings are collated in a constant number of queries'''
+        parents = list(EncodedText.objects.filter(
+            abstracted_text__type__slug__in=['work', 'version']
+        ).exclude(
+            abstracted_text__short_name__in=['HM1', 'HM2']
+        ).select_related('abstracted_text__type'))
+
+        self.assertTrue(parents)
+
+        for group in [parents[:1], parents]:
+            with self.assertNumQueries(3):
+                readings = EncodedText.get_readings_from_members_bulk(group)
+            self.assertEqual(len(readings), len(group))
+
+        # same readings as the collation of a single text
+        for parent in parents:
+            regions, members = parent.get_readings_from_members()
+            self.assertEqual(
+                (regions, members), readings[parent.id][:2]
+            )
+
+    def test_readings_after_member_changes(self):
+        '''The stored readings of a group are rebuilt when a member changes'''
+        member = AbstractedText.objects.filter(
+            type__slug='manuscript', group__isnull=False
+        ).exclude(short_name__in=['HM1', 'HM2']).first()
+        parent = EncodedText.objects.get(
+            abstracted_text_id=member.group_id, type__slug='transcription'
+        )
+
+        def get_label(siglum):
+            return ' {}-text-id"'.format(siglum.lower())
+
+        def get_readings(encoded_text=parent):
+            encoded_text.refresh_from_db()
+            ret = encoded_text.content_with_readings
+            # the same as if computed now, except for the random ids
+            self.assertEqual(
+                re.sub(r'"\d{6,}"', '', ret), re.sub(
+                    r'"\d{6,}"', '',
+                    encoded_text.compute_content_with_readings()
+                )
+            )
+            return ret
+
+        self.assertIn(get_label(member.short_name), get_readings())
+
+        # renamed
+        siglum = member.short_name
+        member.short_name = 'ZZ'
+        member.save()
+        self.assertIn(get_label('ZZ'), get_readings())
+        self.assertNotIn(get_label(siglum), get_readings())
+
+        # left to the caller
+        readings = get_readings()
+        member.short_name = 'YY'
+        member.save(update_readings=False)
+        parent.refresh_from_db()
+        self.assertEqual(parent.content_with_readings, readings)
+        member.short_name = 'ZZ'
+        member.save()
+
+        # removed from the group
+        member.group = None
+        member.save()
+        self.assertNotIn(get_label('ZZ'), get_readings())
+
+        # back in the group
+        member.group = parent.abstracted_text
+        member.save()
+        self.assertIn(get_label('ZZ'), get_readings())
+
+        # transcription deleted: the member has no reading
+        readings = get_readings()
+        member.encoded_texts.get(type__slug='transcription').delete()
+        self.assertNotEqual(get_readings(), readings)
+
+        # text deleted
+        member.delete()
+        self.assertNotIn(get_label('ZZ'), get_readings())
+
+    def test_region_readings_after_member_changes(self):
+        '''The region readings are rebuilt when a member or group changes'''
+        member = AbstractedText.objects.filter(
+            type__slug='manuscript', group__isnull=False
+        ).exclude(short_name__in=['HM1', 'HM2']).first()
+        group = member.group
+
+        def get_region_readings():
+            return list(RegionReading.objects.filter(
+                encoded_text__abstracted_text=member
+            ).order_by('ordinal').values_list('reading', flat=True))
+
+        readings = get_region_readings()
+        self.assertTrue(readings)
+
+        # removed from the group, no parent to read from
+        member.group = None
+        member.save()
+        self.assertEqual(get_region_readings(), [])
+
+        # back in the group
+        member.group = group
+        member.save()
+        self.assertEqual(get_region_readings(), readings)
+
+        # transcription of the group deleted
+        group.encoded_texts.get(type__slug='transcription').delete()
+        self.assertEqual(get_region_readings(), [])
+
+    def test_unique_readings(self):
+        '''The unique readings are marked up, the others unmarked'''
+        contents = [
+            '<p><span id="a1">regem</span> <span id="a2">nemo</span></p>',
+            # marked up by a previous run, no longer unique
+            '<p><span id="b1" data-copies="1">regem</span> '
+            '<span id="b2">bonus</span></p>',
+            None,
+        ]
+        regions = [
+            [('regem', 'a1'), ('regem', 'b1'), ('[absent]', '')],
+            [('nemo', 'a2'), ('bonus', 'b2'), ('[absent]', '')],
+        ]
+        new_contents, missing = ctrstxt.get_contents_with_unique_readings(
+            contents, regions
+        )
+        self.assertEqual(new_contents, [
+            '<p><span id="a1">regem</span> '
+            '<span id="a2" data-copies="1">nemo</span></p>',
+            '<p><span id="b1">regem</span> '
+            '<span id="b2" data-copies="1">bonus</span></p>',
+            None,
+        ])
+        # the member without text
+        self.assertEqual(missing, [(0, 2), (1, 2)])
+
+        # unchanged the second time
+        self.assertEqual(ctrstxt.get_contents_with_unique_readings(
+            new_contents, regions
+        )[0], [None, None, None])
+
+        # nothing to mark up: the readings are not rebuilt
+        def get_readings():
+            return dict(EncodedText.objects.values_list(
+                'id', 'content_with_readings'
+            ))
+
+        readings = get_readings()
+        call_command('ctrstxt', 'unique', stdout=io.StringIO())
+        self.assertEqual(get_readings(), readings)
+
+    def test_xml_tree_cache(self):
+        '''Parsed contents are cached and copied before modification'''
+        et = EncodedText.objects.filter(type__slug='transcription').first()
+        cache = utils.XMLTreeCache(2)
+
+        xml = cache.get(et)
+        self.assertIs(cache.get(et), xml)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+        self.assertEqual(cache.get_stats()['misses'], 1)
+
+        copied = cache.get(et, mutable=True)
+        self.assertIsNot(copied, xml)
+        copied.getroot().clear()
+        self.assertEqual(
+            utils.get_unicode_from_xml(cache.get(et), remove_root=True),
+            utils.get_unicode_from_xml(xml, remove_root=True),
+        )
+        self.assertTrue(len(xml.getroot()))
+
+    def test_heatmap_regions(self):
+        '''The heatmap is assembled from the stored region readings'''
+        members = EncodedText.objects.filter(
+            type__slug='transcription',
+            abstracted_text__type__slug='manuscript',
+            abstracted_text__group__isnull=False,
+        )
+        text_ids = [et.abstracted_text_id for et in members]
+
+        with self.assertNumQueries(2):
+            regions = utils.get_regions_with_unique_variants(text_ids)
+
+        self.assertTrue(regions)
+        # one reading per manuscript for each w-region
+        for region in regions:
+            self.assertEqual(
+                sum(len(sigla) for sigla in region['readings'].values()),
+                len(text_ids)
+            )
+
+    def test_region_counts(self):
+        '''Number of regions per sentence, several sentences per paragraph'''
+        xml = utils.get_xml_from_unicode(
+            '<p><span data-dpt="sn" data-rid="s-1">1</span> a '
+            '<span data-dpt-group="work">b '
+            '<span data-dpt-group="version">c</span></span> '
+            '<span data-dpt="sn" data-rid="s-2">2</span> d '
+            '<span data-dpt-group="work">e</span></p>'
+            '<p>f <span data-dpt-group="work">g</span></p>',
+            ishtml=True, add_root=True
+        )
+        self.assertEqual(utils.get_region_counts_from_xml(xml), {
+            'numbers': ['1', '2'], 'work': [1, 2], 'version': [1, 0],
+        })
+
+        text = EncodedText.objects.exclude(content=None).first()
+        self.assertEqual(
+            text.get_region_counts(), utils.get_region_counts_from_xml(
+                utils.get_xml_from_encoded_text(text)
+            )
+        )
+
+    def test_search_sentences(self):
+        '''Prefix search of all the query words in the sentences'''
+        for q in ['nemo', 'Sco', 'simul bonus', '']:
+            ret = search.search_sentences(q, order='text')
+            self.assertTrue(ret[0])
+            # same results with the database
+            with override_settings(CTRS_TEXTS_SEARCH_INDEX=False):
+                self.assertEqual(
+                    search.search_sentences(q, order='text'), ret
+                )
+
+        # a query without any word matches nothing
+        for q in ['-', '\u2205']:
+            self.assertEqual(search.search_sentences(q), (0, []))
+            with override_settings(CTRS_TEXTS_SEARCH_INDEX=False):
+                self.assertEqual(search.search_sentences(q), (0, []))
+
+        total, ids = search.search_sentences('simul bonus', limit=3)
+        self.assertEqual(len(ids), 3)
+        self.assertGreater(total, 3)
+
+        # ranked: the most occurrences first
+        counts = [
+            len([
+                word
+                for word in search.get_words(sentence.plain)
+                if word.startswith(('simul', 'bonus'))
+            ])
+            for sentence in [
+                Sentence.objects.get(id=sentence_id)
+                for sentence_id in search.search_sentences('simul bonus')[1]
+            ]
+        ]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def search_paragraphs(self, encoded_text, query):
+        '''
+        Returns the plain text of the paragraphs of encoded_text
+        which contain a word beginning with query,
+        the way the texts were searched before the Sentences.
+        '''
+        search_xpath = (
+            r'.//p[re:match(normalize-space(translate(., '
+            r'"ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")'
+            r'), "\b{}\w*\b", "i")]'.format(query.lower())
+        )
+        return [
+            ' '.join(''.join(paragraph.itertext()).split())
+            for paragraph in utils.get_xml_from_encoded_text(
+                encoded_text
+            ).xpath(search_xpath, namespaces={
+                're': 'http://exslt.org/regular-expressions'
+            })
+        ]
+
+    def test_search_all_paragraphs(self):
+        '''All the paragraphs are found by the search, as before'''
+        # text before the first sentence and paragraphs with attributes
+        text = EncodedText.objects.exclude(content=None).first()
+        text.content = '<p>Praefatio nova</p>' + text.content.replace(
+            '<p>', '<p class="para">'
+        )
+        text.save()
+
+        encoded_texts = list(EncodedText.objects.exclude(content=None))
+        queries = sorted(set(
+            word[:4] for word in search.get_words(text.plain)
+        )) + ['praefatio']
+        for query in queries:
+            for encoding_type in ['transcription', 'translation']:
+                hits = {}
+                for sentence in Sentence.objects.filter(
+                    id__in=search.search_sentences(query, encoding_type)[1]
+                ):
+                    hits.setdefault(sentence.encoded_text_id, []).append(
+                        sentence.plain
+                    )
+                for encoded_text in encoded_texts:
+                    if encoded_text.type.slug != encoding_type:
+                        continue
+                    paragraphs = self.search_paragraphs(encoded_text, query)
+                    sentences = hits.get(encoded_text.id, [])
+                    self.assertEqual(bool(paragraphs), bool(sentences))
+                    # each paragraph found is in a sentence found
+                    for paragraph in paragraphs:
+                        self.assertTrue([
+                            sentence for sentence in sentences
+                            if paragraph in sentence
+                        ], paragraph)
+
+        # the text before the first sentence is not part of sentence 1
+        res = self.client.get(reverse('view_api_text_search_sentence'), {
+            'texts': text.abstracted_text_id,
+            'et': text.type.slug,
+            'sn': 1,
+        })
+        sentence = json.loads(res.getvalue().decode('utf-8'))['data'][0]
+        self.assertIn('data-rid="s-1"', sentence['html'])
+        self.assertNotIn('Praefatio', sentence['html'])
+
+    def test_search_highlight(self):
+        '''The words of the query are highlighted as they are searched'''
+        for q in ['bonus.', 'simul,bonus']:
+            res = self.client.get(reverse('view_api_text_search_text'), {
+                'q': q,
+            })
+            hits = json.loads(res.getvalue().decode('utf-8'))['data']
+            self.assertTrue(hits)
+            for hit in hits:
+                for word in search.get_words(q):
+                    self.assertRegex(
+                        hit['html'], '<span class="highlight">' + word
+                    )
+
+        # a query without any word is skipped by the benchmark
+        out = io.StringIO()
+        call_command('ctrstxt', 'bench', 'highlight', '.', 'nemo', stdout=out)
+        self.assertIn("'nemo': 0 different results", out.getvalue())
+
+    def test_search_pagination(self):
+        '''The pages of the text search results, through links.next'''
+        url = reverse('view_api_text_search_text')
+
+        def get_page(url, params=None):
+            res = self.client.get(url, params)
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.getvalue().decode('utf-8'))
+
+        everything = get_page(url, {'q': 'scot', 'limit': 1000})
+        total = everything['meta']['total']
+        self.assertGreater(total, 20)
+        self.assertEqual(len(everything['data']), total)
+        self.assertIsNone(everything['links']['next'])
+
+        # walk through the pages
+        hits = []
+        page = get_page(url, {'q': 'scot', 'limit': 7})
+        while True:
+            self.assertEqual(page['meta']['total'], total)
+            self.assertEqual(page['meta']['offset'], len(hits))
+            self.assertLessEqual(len(page['data']), 7)
+            hits.extend(page['data'])
+            if not page['links']['next']:
+                break
+            page = get_page(page['links']['next'])
+        # all the results, once, in the same order
+        self.assertEqual(hits, everything['data'])
+
+        page = get_page(url, {'q': 'scot', 'limit': 7, 'page': 3})
+        self.assertEqual(page['meta']['offset'], 14)
+        self.assertEqual(page['data'], hits[14:21])
+
+        # default size and maximum size
+        page = get_page(url, {'q': 'scot'})
+        self.assertEqual(page['meta']['limit'], search.get_page_size())
+        page = get_page(url, {'q': 'scot', 'limit': 5000})
+        self.assertEqual(page['meta']['limit'], search.PAGE_SIZE_MAX)
+
+        for params in [
+            {'cursor': 'invalid'}, {'cursor': search.get_cursor(-1)},
+            {'page': 'a'}, {'page': 0}, {'limit': 'a'}, {'limit': 0},
+            {'texts': 'abc'},
+        ]:
+            params['q'] = 'scot'
+            res = self.client.get(url, params)
+            self.assertEqual(res.status_code, 400, params)
+            self.assertEqual(res.json()['errors'][0]['status'], '400')
+
+        # a sentence deleted since the index was built is skipped
+        sentence_id = Sentence.objects.first().id
+        with mock.patch.object(
+            search, 'search_sentences', return_value=(2, [sentence_id, 0])
+        ):
+            page = get_page(url, {'q': 'regem'})
+        self.assertEqual(len(page['data']), 1)
+
+    def test_api_conditional_get(self):
+        '''The API responses are not sent again if the corpus is unchanged'''
+        url = reverse('view_api_texts')
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('max-age', res['Cache-Control'])
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 304)
+
+        EncodedText.objects.first().save()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+
+    def test_api_response_cache(self):
+        '''The API responses are cached until a text is saved'''
+        url = reverse('view_api_texts')
+        content = self.client.get(url).content
+
+        # not invalidated by a bulk update...
+        text = AbstractedText.objects.exclude(short_name='HM1').first()
+        AbstractedText.objects.filter(id=text.id).update(name='Changed')
+        self.assertEqual(self.client.get(url).content, content)
+
+        # ... but by save()
+        text.name = 'Changed'
+        text.save()
+        self.assertIn(b'Changed', self.client.get(url).content)
+
+    def test_api_comparative_chunk(self):
+        '''A comparative chunk contains the chunk of each text, in order'''
+        ids = list(AbstractedText.objects.filter(
+            encoded_texts__type__slug='transcription'
+        ).order_by('-id').values_list('id', flat=True)[:3])
+
+        def get_chunk(text_ids):
+            return self.client.get(reverse('view_api_text_chunk', args=[
+                ','.join(str(text_id) for text_id in text_ids),
+                'histogram', 'whole', 'whole'
+            ])).json()['data']
+
+        chunks = get_chunk(ids)
+        self.assertEqual(len(chunks), len(ids))
+        for text_id, chunk in zip(ids, chunks):
+            self.assertEqual(chunk, get_chunk([text_id]))
+
+    def test_api_compact_chunk(self):
+        '''The compact chunk has the readings of each member in a table'''
+        text = EncodedText.objects.filter(
+            type__slug='transcription', abstracted_text__type__slug='work'
+        ).first()
+        url = reverse('view_api_text_chunk', args=[
+            text.abstracted_text_id, 'transcription', 'whole', 'whole'
+        ])
+
+        full = self.client.get(url)
+        compact = self.client.get(url + '?format=compact')
+        self.assertLess(len(compact.content), len(full.content))
+
+        attributes = compact.json()['data']['attributes']
+        self.assertEqual(attributes['chunk'], text.content)
+
+        regions, members = text.get_readings_from_members()
+        readings = attributes['readings']
+        self.assertEqual(len(readings['members']), len(members))
+        self.assertEqual(len(readings['regions']), len(regions))
+        for region, row in zip(regions, readings['regions']):
+            self.assertEqual([
+                None if reading.get('absent') else
+                [reading['reading'], reading['copies']]
+                for reading in region
+            ], [
+                None if index is None else readings['readings'][index]
+                for index in row
+            ])
+
+    def get_middleware_queries(self):
+        '''
+        Returns the number of queries run by the middlewares for any request
+        (e.g. the Site lookup of wagtail's SiteMiddleware),
+        measured on a view which doesn't run any query itself.
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/texts/viewer/')
+            self.assertEqual(res.status_code, 302)
+        return len(queries)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }})
+    def test_api_queries(self):
+        '''Number of queries of each API endpoint'''
+        ids = list(AbstractedText.objects.values_list('id', flat=True))
+        ms_ids = list(AbstractedText.objects.filter(
+            type__slug='manuscript'
+        ).values_list('id', flat=True))
+        texts = ','.join(str(text_id) for text_id in ids)
+        ms_texts = ','.join(str(text_id) for text_id in ms_ids)
+
+        # two queries for the version of the corpus (ETag)
+        urls = [
+            (3, reverse('view_api_texts')),
+            (3, reverse('view_api_texts') + '?group=declaration'),
+            (4, '{}?sn=5&texts={}'.format(
+                reverse('view_api_text_search_sentence'), texts)),
+            (4, '{}?texts={}'.format(
+                reverse('view_api_text_search_regions'), ms_texts)),
+            (3, '{}?q=scot&texts={}'.format(
+                reverse('view_api_text_search_text'), texts)),
+        ]
+        for view in ['transcription', 'translation', 'histogram']:
+            for slug in [str(ids[0]), str(ms_ids[0]), texts]:
+                urls.append((3, reverse('view_api_text_chunk', args=[
+                    slug, view, 'whole', 'whole'
+                ])))
+
+        search.get_sentence_index()
+
+        overhead = self.get_middleware_queries()
+
+        for num, url in urls:
+            cache.clear()
+            with self.assertNumQueries(overhead + num):
+                res = self.client.get(url)
+                self.assertEqual(res.status_code, 200)
+                # read the streamed responses
+                content = res.getvalue()
+            # cached response
+            with self.assertNumQueries(overhead + 2):
+                res = self.client.get(url)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.getvalue(), content)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }})
+    def test_warm_search_paths(self):
+        '''The search page gets the responses cached by ctrstxt warm'''
+        command = ctrstxt.Command()
+        cache.clear()
+        with mock.patch.object(ctrstxt, 'connections'):
+            for path in command.get_search_paths():
+                self.assertEqual(command.warm_path(path)[1], 200)
+
+        # all the texts selected, in the order of the list of texts
+        texts = self.client.get(
+            reverse('view_api_texts') + '?group=declaration'
+        ).json()['data']
+        texts = ','.join(str(text['id']) for text in texts)
+
+        overhead = self.get_middleware_queries()
+        for name in ['sentence', 'regions']:
+            # the query string of $.getJSON() in fetch_results()
+            url = '{}?texts={}&et=transcription&sn=1&q='.format(
+                reverse('view_api_text_search_' + name),
+                texts.replace(',', '%2C')
+            )
+            # cached response, two queries for the ETag
+            with self.assertNumQueries(overhead + 2):
+                res = self.client.get(url)
+                self.assertEqual(res.status_code, 200)
+
+    def test_iter_json_array_items(self):
+        '''The items of the export are read one at a time, as json.load'''
+        class SlowFile(io.StringIO):
+            # a few characters at a time, to cut the values anywhere
+            def read(self, size=-1):
+                return super().read(5)
+
+        text = json.dumps(OrderedDict([
+            ['count', 4],
+            ['previous', {'a': [1, 2]}],
+            ['empty', []],
+            ['results', [
+                {'id': 1, 'content': '<p>\u00e9 "x"</p>\n' * 20},
+                [1.5, None, True, {}],
+                '',
+                12345678,
+            ]],
+            ['next', None],
+        ]), indent=1)
+        expected = json.loads(text)
+
+        for fh in [io.StringIO(text), SlowFile(text)]:
+            self.assertEqual(
+                list(utils.iter_json_array_items(fh, 'results')),
+                expected['results']
+            )
+        for key in ['empty', 'missing']:
+            self.assertEqual(list(utils.iter_json_array_items(
+                io.StringIO(text), key
+            )), [])
+
+        with open(ARC_TEXT_JSON_PATH, 'rt') as fh:
+            expected = json.load(fh)['results']
+        with open(ARC_TEXT_JSON_PATH, 'rt') as fh:
+            self.assertEqual(
+                list(utils.iter_json_array_items(fh, 'results')), expected
+            )
+
+        # truncated anywhere before the end of the array
+        end = text.index(']', text.index('12345678'))
+        for size in range(end + 1):
+            with self.assertRaises(ValueError, msg=text[:size][-20:]):
+                list(utils.iter_json_array_items(
+                    SlowFile(text[:size]), 'results'
+                ))
+
+        # a truncated export is reported and nothing is imported
+        texts = list(EncodedText.objects.values_list('id', 'content'))
+        with open(ARC_TEXT_JSON_PATH, 'rt') as fh:
+            text = fh.read()
+        with tempfile.NamedTemporaryFile('wt', suffix='.json') as fh:
+            fh.write(text[:len(text) * 2 // 3])
+            fh.flush()
+            stderr = io.StringIO()
+            with mock.patch.object(ctrstxt.Command, 'action_warm') as warm:
+                call_command(
+                    'ctrstxt', 'import', fh.name, force=True, warm=True,
+                    stdout=io.StringIO(), stderr=stderr
+                )
+        self.assertTrue(stderr.getvalue())
+        # and the cache is not warmed
+        warm.assert_not_called()
+        self.assertEqual(
+            list(EncodedText.objects.values_list('id', 'content')), texts
+        )
+
+    def get_imported_state(self):
+        '''
+        Returns the content and the records derived from it
+        of all the EncodedTexts, without the random ids of the readings.
+        '''
+        return [
+            [
+                encoded_text.imported_id, encoded_text.content,
+                encoded_text.plain, encoded_text.content_hash,
+                encoded_text.region_counts,
+                re.sub(
+                    r'"\d{6,}"', '', encoded_text.content_with_readings or ''
+                ),
+                list(encoded_text.sentences.values_list('number', 'plain')),
+                list(encoded_text.region_readings.order_by(
+                    'ordinal'
+                ).values_list('reading', flat=True)),
+            ]
+            for encoded_text in EncodedText.objects.order_by('imported_id')
+        ]
+
+    def test_import_jobs(self):
+        '''Importing with several processes gives the same result'''
+        state = self.get_imported_state()
+        for jobs in [1, 3]:
+            call_command(
+                'ctrstxt', 'import', ARC_TEXT_JSON_PATH, jobs=jobs,
+                force=True, stdout=io.StringIO()
+            )
+            self.assertEqual(self.get_imported_state(), state, jobs)
+
+    def test_import_unchanged(self):
+        '''Only the texts which source has changed are imported again'''
+        with open(ARC_TEXT_JSON_PATH, 'rt') as fh:
+            export = json.load(fh)
+        texts = EncodedText.objects.exclude(content=None).order_by('id')
+        # a member of a group with other members
+        changed = texts.filter(
+            abstracted_text__type__slug='manuscript',
+            abstracted_text__group__isnull=False,
+        ).first()
+        # changed in the database only: a skipped text keeps that change
+        skipped = texts.exclude(
+            abstracted_text__group_id=changed.abstracted_text.group_id
+        ).first()
+        EncodedText.objects.filter(id=skipped.id).update(content='<p>x</p>')
+
+        # new source content for the other one
+        for record in export['results']:
+            if record['text_content']['id'] == changed.imported_id:
+                record['content'] = record['content'].replace(
+                    '</p>', ' addendum</p>', 1
+                )
+
+        def import_export(**options):
+            with tempfile.NamedTemporaryFile('wt', suffix='.json') as fh:
+                json.dump(export, fh)
+                fh.flush()
+                call_command(
+                    'ctrstxt', 'import', fh.name, stdout=io.StringIO(),
+                    **options
+                )
+
+        def get_sentence_ids():
+            return set(Sentence.objects.exclude(
+                encoded_text_id=changed.id
+            ).values_list('id', flat=True))
+
+        sentence_ids = get_sentence_ids()
+        import_export()
+        self.assertEqual(
+            EncodedText.objects.get(id=skipped.id).content, '<p>x</p>'
+        )
+        # the other members of the group are not written again
+        self.assertEqual(get_sentence_ids(), sentence_ids)
+        self.assertIn(
+            'addendum', EncodedText.objects.get(id=changed.id).content
+        )
+
+        import_export(force=True)
+        self.assertEqual(
+            EncodedText.objects.get(id=skipped.id).content, skipped.content
+        )
+
+    def test_annotations_cache(self):
+        '''The annotations are read again when their file is modified'''
+        def write_annotations(text):
+            with open(utils.get_annotations_path(), 'wt') as fh:
+                json.dump({'results': [{'geo_json': json.dumps({
+                    'geometry': {'coordinates': [[[0, 1], [0, 2], [3, 4]]]},
+                    'properties': {'elementid': [
+                        ['', 'seg'], ['@text', text]
+                    ]},
+                })}]}, fh)
+
+        def get_heatmap_annotations():
+            res = self.client.get(reverse('view_api_text_search_regions'))
+            self.assertEqual(res.status_code, 200)
+            return json.loads(
+                res.getvalue().decode('utf-8')
+            )['data'][0]['annotations']
+
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            write_annotations('regem')
+            annotations = utils.get_annotations_from_archetype()
+            self.assertEqual(list(annotations.keys()), ['regem'])
+            # read and encoded once
+            self.assertIs(utils.get_annotations_from_archetype(), annotations)
+            self.assertEqual(get_heatmap_annotations(), annotations)
+
+            # same size, later modification time
+            path = utils.get_annotations_path()
+            mtime = os.stat(path).st_mtime_ns
+            write_annotations('regis')
+            os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+            annotations = utils.get_annotations_from_archetype()
+            self.assertEqual(list(annotations.keys()), ['regis'])
+            self.assertIn(
+                'regis', utils.get_annotations_from_archetype(serialized=True)
+            )
+            # the cached heatmap is not sent again
+            self.assertEqual(get_heatmap_annotations(), annotations)
+
+    def test_iter_json(self):
+        '''Streamed json is the same as the json encoded at once'''
+        for encoder in serializers.get_encoder_names():
+            value = OrderedDict([
+                ['a', [1, (i for i in [{'b': [2, 3]}, []])]],
+                ['c', serializers.JSONFragment('{"d": 4}')],
+                ['e', iter([])],
+                ['f', {}],
+            ])
+            self.assertEqual(
+                json.loads(''.join(serializers.iter_json(value, encoder))),
+                {'a': [1, [{'b': [2, 3]}, []]], 'c': {'d': 4}, 'e': [],
+                 'f': {}}
+            )
+
+            value = {'a': [1, 'b', None], 'c': {'d': 1.5}}
+            self.assertEqual(
+                ''.join(serializers.iter_json(value, encoder)),
+                serializers.dumps(value, encoder)
+            )
@@ -1,6 +1,10 @@
+import copy
+import hashlib
 import json
 import os
 import re
+import threading
+import uuid
 from collections import Counter
 
 import lxml.etree as ET
@@ -9,6 +13,8 @@ from django.conf import settings
 from django.utils.text import slugify
 from lxml import html
 
+from . import serializers
+
 
 def get_xml_from_unicode(document, ishtml=False, add_root=False):
     # document = a unicode object containing the document
@@ -35,6 +41,81 @@ def get_xml_from_unicode(document, ishtml=False, add_root=False):
     return ret
 
 
+class XMLTreeCache:
+    '''
+    Process-local LRU cache of parsed EncodedText contents.
+    Keyed by (EncodedText.id, EncodedText.modified).
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, encoded_text, mutable=False):
+        key = (encoded_text.id, encoded_text.modified)
+        if key[0] is None or key[1] is None or self.size < 1:
+            # unsaved text, no reliable key
+            return get_xml_from_unicode(
+                encoded_text.content, ishtml=True, add_root=True
+            )
+
+        with self.lock:
+            ret = self.trees.get(key, None)
+            if ret is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.trees.move_to_end(key)
+
+        if ret is None:
+            ret = get_xml_from_unicode(
+                encoded_text.content, ishtml=True, add_root=True
+            )
+            with self.lock:
+                self.trees[key] = ret
+                while len(self.trees) > self.size:
+                    self.trees.popitem(last=False)
+
+        if mutable:
+            # copy-on-write: the cached tree must never be modified
+            ret = copy.deepcopy(ret)
+
+        return ret
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        return {
+            'size': len(self.trees),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+xml_tree_cache = XMLTreeCache(
+    getattr(settings, 'CTRS_TEXTS_XML_CACHE_SIZE', 100)
+)
+
+
+def get_xml_from_encoded_text(encoded_text, mutable=False):
+    '''
+    Returns the parsed content of an EncodedText
+    (same as get_xml_from_unicode(content, ishtml=True, add_root=True)).
+
+    The tree is cached in memory, see XMLTreeCache.
+    Set mutable=True to get a copy you can safely modify.
+    '''
+    return xml_tree_cache.get(encoded_text, mutable=mutable)
+
+
 def get_unicode_from_xml(xmltree, encoding='utf-8',
                          text_only=False, remove_root=False):
     # if text_only = True => strip all XML tags
@@ -111,20 +192,95 @@ def append_xml_element(
     return ret
 
 
-def get_sentence_from_text(encoded_text, sentence_number):
-    ret = ''
+def get_regions_from_xml(xml):
+    '''
+    Returns a list of dictionaries, one for each unsettled region
+    (work or version) in xml, in their order of appearance.
+    See Region model.
+    '''
+    ret = []
 
-    # ac-139 we remove all auxiliary sentences first
-    content = re.sub('<p[^>]+data-dpt-type="auxiliary".*?</p>',
-                     '', encoded_text.content)
+    ordinals = Counter()
+    for region in xml.findall('.//span[@data-dpt-group]'):
+        group = region.attrib['data-dpt-group']
+        if group not in ['work', 'version']:
+            continue
+        ret.append({
+            'group': group,
+            'ordinal': ordinals[group],
+            'rid': region.attrib.get('data-rid', ''),
+            'element_id': region.attrib.get('id', ''),
+            'copies': region.attrib.get('data-copies', '0'),
+            'reading': get_unicode_from_xml(region, text_only=True),
+        })
+        ordinals.update([group])
+
+    return ret
+
+
+def get_region_counts_from_xml(xml):
+    '''
+    Returns the number of unsettled regions of each group (work, version)
+    in each sentence of xml, in their order of appearance:
+    {'numbers': [sentence number, ...],
+     'work': [count, ...], 'version': [count, ...]}
+
+    A sentence goes from its number (data-dpt="sn") to the next one.
+    See EncodedText.region_counts.
+    '''
+    ret = OrderedDict([['numbers', []], ['work', []], ['version', []]])
+
+    for span in xml.iter('span'):
+        if span.attrib.get('data-dpt', '') == 'sn':
+            number = re.match(r'^s-(\d+)$', span.attrib.get('data-rid', ''))
+            if not number:
+                continue
+            ret['numbers'].append(number.group(1))
+            ret['work'].append(0)
+            ret['version'].append(0)
+            continue
+
+        group = span.attrib.get('data-dpt-group', '')
+        if group in ['work', 'version'] and ret['numbers']:
+            ret[group][-1] += 1
+
+    return ret
+
+
+# ac-139 auxiliary sentences are not numbered sentences
+AUXILIARY_PARAGRAPH_PATTERN = re.compile(
+    '<p[^>]+data-dpt-type="auxiliary".*?</p>'
+)
 
-    pattern = ''.join([
+
+# a paragraph, see get_sentences_from_content()
+PARAGRAPH_PATTERN = re.compile(r'(?usi)<p\b[^>]*>.*?</p>')
+
+# a paragraph which begins with a sentence number
+SENTENCE_NUMBER_PATTERN = re.compile(
+    r'(?usi)<p\b[^>]*>\s*<span[^>]+data-rid="s-([^"]+)"'
+)
+
+
+def get_sentence_pattern(sentence_number):
+    return re.compile(''.join([
         r'(?usi)(<p>\s*<span[^>]+data-rid="s-',
         re.escape(str(sentence_number)),
         r'".*?</p>)\s*(<p>\s*<span data-dpt="sn"|$)'
-    ])
+    ]))
+
 
-    match = re.search(pattern, content)
+def get_sentence_from_text(encoded_text, sentence_number):
+    '''
+    Returns the HTML of a numbered sentence found in the content.
+    Only used as the reference for the stored Sentences in the tests.
+    '''
+    ret = ''
+
+    # ac-139 we remove all auxiliary sentences first
+    content = AUXILIARY_PARAGRAPH_PATTERN.sub('', encoded_text.content)
+
+    match = get_sentence_pattern(sentence_number).search(content)
 
     if match:
         ret = match.group(1)
@@ -132,97 +288,297 @@ def get_sentence_from_text(encoded_text, sentence_number):
     return ret
 
 
-def get_regions_with_unique_variants(text_ids):
+def get_sentences_from_content(content):
+    '''
+    Returns a list of all the sentences in content,
+    in their order of appearance. See Sentence model.
+
+    Each sentence is a dictionary with:
+        number: the sentence number (e.g. '12'), '' if none
+        html: the HTML of the sentence
+        plain: the plain text of the sentence, with normalised spaces
+        auxiliary: True for an auxiliary paragraph
+        ordinal: the position of the sentence in the text
+
+    A sentence is a paragraph which begins with a sentence number
+    followed by the paragraphs without number, as get_sentence_from_text().
+    The paragraphs before the first number form a sentence without number
+    so they can be searched but are not returned with the first sentence.
+    '''
     ret = []
 
-    # build ret: list of all wregions in HM1, in their order of appearance.
-    # for each region, ['key'] is a key that will match the annotation key
-    # see _get_annotations_from_archetype()
-    wpattern = './/span[@data-dpt-group="work"]'
+    if not content:
+        return ret
 
+    # positions in content of the removed auxiliary paragraphs
+    removed = []
+    for match in AUXILIARY_PARAGRAPH_PATTERN.finditer(content):
+        removed.append((match.start(), match.end()))
+        number = re.search(r'data-rid="s-([^"]+)"', match.group(0))
+        ret.append((match.start(), {
+            'number': number.group(1) if number else '',
+            'html': match.group(0),
+            'auxiliary': True,
+        }))
+
+    content_main = AUXILIARY_PARAGRAPH_PATTERN.sub('', content)
+
+    # [[start, end, number], ...] in content_main, one per sentence
+    spans = []
+    for match in PARAGRAPH_PATTERN.finditer(content_main):
+        number = SENTENCE_NUMBER_PATTERN.match(match.group(0))
+        if spans and not number:
+            spans[-1][1] = match.end()
+        else:
+            spans.append([
+                match.start(), match.end(), number.group(1) if number else ''
+            ])
+
+    for start, end, number in spans:
+        # position of the sentence in content (i.e. before removals)
+        position = start
+        for removed_start, removed_end in removed:
+            if removed_start > position:
+                break
+            position += removed_end - removed_start
+
+        ret.append((position, {
+            'number': number,
+            'html': content_main[start:end],
+            'auxiliary': False,
+        }))
+
+    ret = [sentence for position, sentence in sorted(
+        ret, key=lambda s: s[0]
+    )]
+
+    for i, sentence in enumerate(ret):
+        sentence['ordinal'] = i
+        sentence['plain'] = ' '.join(
+            html.fromstring(sentence['html']).text_content().split()
+        )
+
+    return ret
+
+
+def get_regions_with_unique_variants(text_ids):
+    '''
+    Returns the w-regions of HM1 with the readings of the manuscripts
+    in text_ids (AbstractedText ids), for the heatmap.
+    See iter_regions_with_unique_variants().
+    '''
+    return list(iter_regions_with_unique_variants(text_ids))
+
+
+def iter_regions_with_unique_variants(text_ids):
+    '''
+    Yields the w-regions of HM1 with the readings of the manuscripts
+    in text_ids (AbstractedText ids), for the heatmap,
+    in their order of appearance.
+    The readings are precomputed, see EncodedText.update_region_readings(),
+    and read one region at a time.
+    '''
+    # list of the keys of all wregions in HM1, in their order of appearance.
+    # each key will match the annotation key
+    # see _get_annotations_from_archetype()
+    keys = []
     keys_freq = Counter()
 
-    from ctrs_texts.models import EncodedText
+    from ctrs_texts.models import Region, RegionReading
 
-    for encoded_text in EncodedText.objects.filter(
-        abstracted_text__short_name__in=['HM1'],
-        type__slug='transcription'
+    for reading in Region.objects.filter(
+        encoded_text__abstracted_text__short_name__in=['HM1'],
+        encoded_text__type__slug='transcription',
+        group='work',
+    ).order_by('encoded_text_id', 'ordinal').values_list(
+        'reading', flat=True
     ):
-        content = get_xml_from_unicode(
-            encoded_text.content, ishtml=True, add_root=True
-        )
-        for wregion in content.findall(wpattern):
-            key = slugify(get_unicode_from_xml(wregion, text_only=True))[:20]
-            key = key or '∅'
-            keys_freq.update([key])
-            freq = keys_freq[key]
-            if freq > 1:
-                key = '{}:{}'.format(key, freq)
-            ret.append({
-                'key': key,
-                'readings': OrderedDict()
-            })
-
-    # for each selected manuscript, get its parent w-regions
+        key = slugify(reading)[:20]
+        key = key or '∅'
+        keys_freq.update([key])
+        freq = keys_freq[key]
+        if freq > 1:
+            key = '{}:{}'.format(key, freq)
+        keys.append(key)
+
+    # for each selected manuscript, the text of its parent w-regions
     # where all v-regions have been substituted with the content from the MS
-    vpattern = './/span[@data-dpt-group="version"]'
-
-    for encoded_text in EncodedText.objects.filter(
-        abstracted_text_id__in=text_ids,
-        type__slug='transcription',
-        abstracted_text__type__slug='manuscript',
-    ).order_by('abstracted_text__short_name'):
-        member_siglum = encoded_text.abstracted_text.short_name
-
-        # get vregions from member
-        vregions = []
-        content = get_xml_from_unicode(
-            encoded_text.content, ishtml=True, add_root=True
+    readings = RegionReading.objects.filter(
+        encoded_text__abstracted_text_id__in=text_ids,
+        encoded_text__type__slug='transcription',
+        encoded_text__abstracted_text__type__slug='manuscript',
+    ).order_by(
+        'ordinal', 'encoded_text__abstracted_text__short_name',
+        'encoded_text_id'
+    ).values_list(
+        'encoded_text__abstracted_text__short_name',
+        'encoded_text__abstracted_text__group__short_name',
+        'ordinal', 'reading'
+    ).iterator()
+
+    row = next(readings, None)
+    for i, key in enumerate(keys):
+        region = {
+            'key': key,
+            'readings': OrderedDict()
+        }
+        while row is not None and row[2] == i:
+            member_siglum, parent_siglum, _, wreading = row
+            if wreading not in region['readings']:
+                region['readings'][wreading] = []
+            region['readings'][wreading].append(
+                [parent_siglum, member_siglum])
+            row = next(readings, None)
+        yield region
+
+    while row is not None:
+        print('WARNING: w-region #{} of {} not found in {}'.format(
+            row[2], row[1], 'heatmap text (HM1)')
         )
-        for vregion in content.findall(vpattern):
-            vregions.append(get_unicode_from_xml(vregion, text_only=True))
+        row = next(readings, None)
 
-        # print(vregions)
 
-        # get parent
-        parent = EncodedText.objects.filter(
-            abstracted_text=encoded_text.abstracted_text.group,
-            type__slug='transcription',
-        ).first()
+def get_wregion_readings(content_parent, vregions, member='', parent=''):
+    '''
+    Returns the plain text reading of each w-region of a parent text
+    where all the v-regions have been substituted with the readings
+    of a member.
 
-        content_parent = get_xml_from_unicode(
-            parent.content, ishtml=True, add_root=True
-        )
-        parent_siglum = parent.abstracted_text.short_name
+    content_parent: parsed content of the parent, it will be modified
+    vregions: the plain text reading of each v-region of the member
+    member, parent: only used in the warnings
+    '''
+    wpattern = './/span[@data-dpt-group="work"]'
+    vpattern = './/span[@data-dpt-group="version"]'
 
-        # replace vregion in parent with text from member
-        for i, vregion in enumerate(content_parent.findall(vpattern)):
-            if i < len(vregions):
-                vregion.clear(keep_tail=True)
-                vregion.text = vregions[i]
-            else:
-                print('WARNING: v-region #{} of {} not found in {}'.format(
-                    i, encoded_text, parent)
-                )
-
-        # get the text of all the wregions from parent
-        for i, wregion in enumerate(content_parent.findall(wpattern)):
-            if i < len(ret):
-                wreading = get_unicode_from_xml(wregion, text_only=True)
-                wreading = wreading.strip()
-                if wreading not in ret[i]['readings']:
-                    ret[i]['readings'][wreading] = []
-                ret[i]['readings'][wreading].append(
-                    [parent_siglum, member_siglum])
-            else:
-                print('WARNING: w-region #{} of {} not found in {}'.format(
-                    i, parent, 'heatmap text (HM1)')
-                )
+    # replace vregion in parent with text from member
+    for i, vregion in enumerate(content_parent.findall(vpattern)):
+        if i < len(vregions):
+            vregion.clear(keep_tail=True)
+            vregion.text = vregions[i]
+        else:
+            print('WARNING: v-region #{} of {} not found in {}'.format(
+                i, member, parent)
+            )
 
-    return ret
+    # get the text of all the wregions from parent
+    return [
+        get_unicode_from_xml(wregion, text_only=True).strip()
+        for wregion in content_parent.findall(wpattern)
+    ]
 
 
-def get_annotations_from_archetype():
+class JSONStreamReader:
+    '''
+    Decodes a json file incrementally, one value at a time.
+    See iter_json_array_items().
+    '''
+
+    def __init__(self, fh, chunk_size=1 << 16):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''Read more from the file. Returns False at the end of the file'''
+        if self.eof:
+            return False
+        # read at least as much as we have, so a large value
+        # is decoded after a logarithmic number of attempts
+        chunk = self.fh.read(max(self.chunk_size, len(self.buffer)))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return not self.eof
+
+    def peek(self):
+        '''Returns the next non-space character, '' at the end'''
+        while True:
+            size = len(self.buffer)
+            while self.pos < size and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < size or not self.fill():
+                break
+        return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        ret = self.peek()
+        if not ret or ret not in chars:
+            raise ValueError('Expected {} at {!r}'.format(
+                ' or '.join(chars), self.buffer[self.pos:self.pos + 20]
+            ))
+        self.pos += 1
+        return ret
+
+    def decode(self):
+        '''Returns the next json value'''
+        self.peek()
+        while True:
+            try:
+                ret, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may be truncated
+                if end < len(self.buffer) or not self.fill():
+                    self.pos = end
+                    return ret
+            except ValueError:
+                if not self.fill():
+                    raise
+
+
+def iter_json_array_items(fh, key):
+    '''
+    Yields the items of the array under key in the json object in file fh.
+    Unlike json.load(fh)[key] only one item is kept in memory at a time.
+    '''
+    reader = JSONStreamReader(fh)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.decode()
+                if reader.expect(',]') == ']':
+                    return
+        else:
+            reader.decode()
+        if reader.expect(',}') == '}':
+            return
+
+
+def get_batches(items, size):
+    '''Yields lists of up to size items from the iterable items'''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# {'annotations': (file key, annotations, serialized annotations)}
+# see get_annotations_from_archetype()
+annotations_cache = {}
+annotations_cache_lock = threading.Lock()
+
+
+def get_annotations_path():
+    '''Returns the path of the annotations file exported from archetype'''
+    return os.path.join(settings.MEDIA_ROOT, 'arch-annotations.json')
+
+
+def get_annotations_from_archetype(serialized=False):
     '''
     Returns a simplified dictionary of annotations from archetype api.
 
@@ -234,12 +590,35 @@ def get_annotations_from_archetype():
             ]
         ]
     },
+
+    The dictionary is built once and kept in memory until the file
+    is modified. It is shared, don't modify it.
+    serialized=True to get it as a JSON string.
+    '''
+    annotation_path = get_annotations_path()
+    stat = os.stat(annotation_path)
+    key = (annotation_path, stat.st_mtime_ns, stat.st_size)
+
+    with annotations_cache_lock:
+        cached = annotations_cache.get('annotations', None)
+
+    if cached is None or cached[0] != key:
+        ret = read_annotations_from_archetype(annotation_path)
+        cached = (key, ret, serializers.dumps(ret))
+        with annotations_cache_lock:
+            annotations_cache['annotations'] = cached
+
+    return cached[2] if serialized else cached[1]
+
+
+def read_annotations_from_archetype(annotation_path):
+    '''
+    Returns a simplified dictionary of annotations
+    from a file exported from archetype api.
+    See get_annotations_from_archetype().
     '''
     ret = {}
 
-    annotation_path = os.path.join(
-        settings.MEDIA_ROOT, 'arch-annotations.json'
-    )
     with open(annotation_path, 'rt') as fh:
         api_response = json.load(fh)
 
@@ -268,65 +647,161 @@ def get_annotations_from_archetype():
     return ret
 
 
-def get_text_chunk(encoded_text, view, region_type):
+def get_text_chunk(encoded_text, view, region_type, content=None):
+    '''
+    Returns the chunk of encoded_text for the view.
+    content: the content with readings of encoded_text if already available,
+        see EncodedText.get_contents_with_readings().
+    '''
     if view in ['histogram']:
-        '''Returns a list of sentences; for each one, the number of regions'''
-        ret = []
-
-        xml = get_xml_from_unicode(
-            encoded_text.content, add_root=True, ishtml=True)
-        for para in xml.findall('.//p'):
-            for sentence_element in para.findall('.//span[@data-dpt="sn"]'):
-                number = re.sub(r'^s-(\d+)$', r'\1',
-                                sentence_element.attrib.get('data-rid', ''))
-                if not number:
-                    continue
-
-                regions = para.findall(
-                    './/span[@data-dpt-group="' + region_type + '"]')
-
-                res = {
-                    'key': number,
-                    'value': len(regions),
-                }
-                ret.append(res)
+        # a list of sentences; for each one, the number of regions
+        counts = encoded_text.get_region_counts()
+        ret = [
+            {
+                'key': number,
+                'value': value,
+            }
+            for number, value in zip(counts['numbers'], counts[region_type])
+        ]
+    elif content is not None:
+        ret = content
     else:
         ret = encoded_text.get_content_with_readings()
 
     return ret
 
 
-def search_text(encoded_text, query=''):
-    if not encoded_text:
-        return None
+# a tag or the text between two tags, see highlight_html()
+HTML_TAG_PATTERN = re.compile(r'(<[^>]*>)')
 
-    query = query.lower()
 
-    lowercase = (
-        'translate(., '
-        '"ABCDEFGHIJKLMNOPQRSTUVWXYZ", '
-        '"abcdefghijklmnopqrstuvwxyz")'
-    )
-    search_pattern = get_text_search_pattern()
-    search_xpath = (
-        r'.//p[re:match(normalize-space({}), "{}", "i")]'.format(
-            lowercase, search_pattern.format(query))
-    )
+def highlight_html(html, pattern):
+    '''
+    Returns html where the matches of pattern in the text
+    (i.e. not in the tags) are wrapped in a span.highlight.
+    See search.get_highlight_pattern().
+    Runs in linear time: the html is split into tags and text,
+    only the text is searched.
+    '''
+    if pattern is None:
+        return html
+
+    replacement = r'<span class="highlight">\1</span>'
+
+    parts = HTML_TAG_PATTERN.split(html)
+    # even: text, odd: tag
+    for i in range(0, len(parts), 2):
+        if parts[i]:
+            parts[i] = pattern.sub(replacement, parts[i])
+
+    return ''.join(parts)
+
+
+def get_db_search_pattern(query):
+    '''
+    Returns a regex for the database which matches the words
+    beginning with query.
+    PostgreSQL uses \\m for the beginning of a word
+    (see the trigram index on Sentence.plain),
+    the other backends use \\b (e.g. sqlite uses Python's re).
+    '''
+    from django.db import connection
+
+    boundary = r'\m' if connection.vendor == 'postgresql' else r'\b'
+
+    # only escape the special characters, the rest is the same
+    # in both dialects
+    return boundary + re.sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', query)
+
+
+def get_corpus_version():
+    '''
+    Returns a string which changes each time a text is added, changed
+    or removed. E.g. to invalidate the data derived from the corpus.
+    '''
+    return get_corpus_stats()[0]
+
 
-    xml = get_xml_from_unicode(
-        encoded_text.content, ishtml=True, add_root=True)
+def get_corpus_stats():
+    '''
+    Returns (version, last_modified) of the corpus.
+    version: see get_corpus_version()
+    last_modified: the most recent modification date of a text
+        (None if there is no text)
+    '''
+    from django.db.models import Count, Max
+    from ctrs_texts.models import AbstractedText, EncodedText
 
-    results = [get_unicode_from_xml(sentence)
-               for sentence in xml.xpath(
-                   search_xpath,
-                   namespaces={'re': 'http://exslt.org/regular-expressions'})
-               ]
+    version = []
+    last_modified = None
+    for model in [EncodedText, AbstractedText]:
+        stats = model.objects.aggregate(Count('id'), Max('modified'))
+        modified = stats['modified__max']
+        version.append('{}:{}'.format(
+            stats['id__count'], modified.timestamp() if modified else 0
+        ))
+        if modified and (last_modified is None or modified > last_modified):
+            last_modified = modified
 
-    return results
+    return '-'.join(version), last_modified
 
 
-def get_text_search_pattern():
-    return r'\b{}\w*\b'
+# cache key of the version of the API responses,
+# see get_api_cache_version()
+API_CACHE_VERSION_KEY = 'ctrs_texts:api:version'
+
+
+def get_api_cache_version():
+    '''
+    Returns the current version of the cached API responses.
+    See bump_api_cache_version().
+    '''
+    from django.core.cache import cache
+
+    ret = cache.get(API_CACHE_VERSION_KEY)
+    if ret is None:
+        ret = bump_api_cache_version()
+
+    return ret
+
+
+def bump_api_cache_version():
+    '''
+    Invalidates all the cached API responses.
+    Must be called after any change to the texts
+    (e.g. save(), ctrstxt import, unique or delete).
+    Returns the new version.
+    '''
+    from django.core.cache import cache
+
+    ret = uuid.uuid4().hex
+    cache.set(API_CACHE_VERSION_KEY, ret, None)
+
+    return ret
+
+
+def get_api_cache_key(path, params, extra=''):
+    '''
+    Returns the cache key of an API response.
+    path: the path of the request
+    params: a QueryDict with the request parameters, in any order
+    extra: anything else the response depends on
+    '''
+    normalised = sorted(
+        (k, v) for k, vs in params.lists() for v in vs
+    )
+
+    return 'ctrs_texts:api:{}:{}'.format(
+        get_api_cache_version(),
+        hashlib.sha1(json.dumps(
+            [path, normalised, extra]
+        ).encode('utf-8')).hexdigest()
+    )
+
+
+def get_content_hash(content):
+    '''Returns a hash of a text content, see EncodedText.source_hash'''
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
 
 
 def get_plain_text(encoded_text):
@@ -334,7 +809,15 @@ def get_plain_text(encoded_text):
     if not encoded_text:
         return None
 
-    xml = html.fromstring(encoded_text.content)
+    return get_plain_text_from_content(encoded_text.content)
+
+
+def get_plain_text_from_content(content):
+    '''Returns the plain text from an XML content.'''
+    if not content:
+        return None
+
+    xml = html.fromstring(content)
     text = xml.text_content()
 
     if not text:
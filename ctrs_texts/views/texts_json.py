@@ -1,14 +1,212 @@
-import re
+import os
+from datetime import datetime
+from functools import wraps
 
 from _collections import OrderedDict
-from ctrs_texts.models import AbstractedText, EncodedText
+from ctrs_texts.models import AbstractedText, EncodedText, Sentence
+from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Q
-from django.http import JsonResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
-from .. import utils
+from .. import search, serializers, utils
 
 
+def get_corpus_stats(request):
+    '''
+    Returns utils.get_corpus_stats(), computed once per request.
+    '''
+    if not hasattr(request, 'corpus_stats'):
+        request.corpus_stats = utils.get_corpus_stats()
+    return request.corpus_stats
+
+
+def get_api_etag(request, *args, **kwargs):
+    return get_corpus_stats(request)[0]
+
+
+def get_api_last_modified(request, *args, **kwargs):
+    return get_corpus_stats(request)[1]
+
+
+def get_regions_etag(request, *args, **kwargs):
+    # the heatmap also depends on the annotations file
+    stat = os.stat(utils.get_annotations_path())
+    return '{}-{}'.format(get_api_etag(request), stat.st_mtime_ns)
+
+
+def get_regions_last_modified(request, *args, **kwargs):
+    ret = get_api_last_modified(request)
+    modified = datetime.fromtimestamp(
+        os.path.getmtime(utils.get_annotations_path()), timezone.utc
+    )
+    if not settings.USE_TZ:
+        # same as the dates from the database
+        modified = timezone.make_naive(modified)
+    if ret is None or modified > ret:
+        ret = modified
+    return ret
+
+
+def get_regions_cache_key_extra(request, *args, **kwargs):
+    return os.stat(utils.get_annotations_path()).st_mtime_ns
+
+
+# size of the chunks of the streamed responses, in characters
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+
+def get_buffered(chunks, size=STREAMING_CHUNK_SIZE):
+    '''Yields the strings in chunks joined into strings of ~size'''
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+class JsonApiResponse(HttpResponse):
+    '''
+    Same as JsonResponse(data) but encoded with the fastest encoder
+    available, see serializers.encode().
+    '''
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(serializers.encode(data), **kwargs)
+
+
+class JsonApiErrorResponse(JsonApiResponse):
+    '''
+    A json api error document, e.g. for an invalid request (status=400).
+    See https://jsonapi.org/format/#errors
+    '''
+
+    def __init__(self, detail, status=400, **kwargs):
+        super().__init__(OrderedDict([
+            ['jsonapi', '1.0'],
+            ['errors', [OrderedDict([
+                ['status', str(status)],
+                ['detail', detail],
+            ])]],
+        ]), status=status, **kwargs)
+
+
+class JsonApiStreamingResponse(StreamingHttpResponse):
+    '''
+    A json response sent while it is being encoded.
+    Same content as JsonApiResponse(data), but the iterators in data
+    (e.g. a generator of the items of data['data']) are only consumed
+    as the response is sent, see serializers.iter_json().
+    '''
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(
+            get_buffered(serializers.iter_json(data)), **kwargs
+        )
+
+
+def iter_cached_content(streaming_content, key, content_type):
+    '''
+    Yields the chunks of a streamed response
+    and caches the whole content once they have all been sent.
+    See api_response_cache().
+    '''
+    chunks = []
+    for chunk in streaming_content:
+        chunks.append(chunk)
+        yield chunk
+
+    cache.set(
+        key, (content_type, b''.join(chunks)),
+        getattr(settings, 'CTRS_TEXTS_API_CACHE_TIMEOUT', 86400)
+    )
+
+
+def api_response_cache(get_key_extra=None):
+    '''
+    Decorator which caches the successful responses of an API view
+    in the default cache (redis), for settings.CTRS_TEXTS_API_CACHE_TIMEOUT
+    seconds (default one day).
+    Keyed by the path, the parameters and the version of the cache,
+    see utils.get_api_cache_key().
+    get_key_extra: optional function, same arguments as the view,
+        which returns anything else the response depends on.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+
+            key = utils.get_api_cache_key(
+                request.path, request.GET,
+                get_key_extra(request, *args, **kwargs)
+                if get_key_extra else ''
+            )
+
+            cached = cache.get(key)
+            if cached is not None:
+                return HttpResponse(cached[1], content_type=cached[0])
+
+            ret = view(request, *args, **kwargs)
+
+            if ret.status_code == 200:
+                if ret.streaming:
+                    # cached once it has been sent
+                    ret.streaming_content = iter_cached_content(
+                        ret.streaming_content, key, ret['Content-Type']
+                    )
+                else:
+                    cache.set(
+                        key, (ret['Content-Type'], ret.content),
+                        getattr(
+                            settings, 'CTRS_TEXTS_API_CACHE_TIMEOUT', 86400
+                        )
+                    )
+
+            return ret
+
+        return wrapper
+
+    return decorator
+
+
+def api_cache(
+    etag_func=get_api_etag, last_modified_func=get_api_last_modified,
+    get_key_extra=None
+):
+    '''
+    Decorator for the API views which only depend on the corpus.
+    Supports conditional GET (ETag / Last-Modified -> 304)
+    and lets the browsers and proxies cache the response
+    for settings.CTRS_TEXTS_API_MAX_AGE seconds (default 60).
+    The ETag changes as soon as a text is added, modified or deleted.
+    The responses are also cached on the server, see api_response_cache().
+    '''
+    def decorator(view):
+        return cache_control(
+            public=True,
+            max_age=getattr(settings, 'CTRS_TEXTS_API_MAX_AGE', 60),
+        )(condition(
+            etag_func=etag_func, last_modified_func=last_modified_func
+        )(api_response_cache(get_key_extra)(view)))
+
+    return decorator
+
+
+@api_cache()
 def view_api_texts(request):
     '''
     Returns json with a list of AbstractedTexts.
@@ -72,9 +270,57 @@ def view_api_texts(request):
         ['data', texts],
     ])
 
-    return JsonResponse(ret)
+    return JsonApiResponse(ret)
+
+
+def get_text_chunk_resource(
+    encoded_text, view, unit, location, content, readings=None
+):
+    '''
+    Returns the json:api resource of the chunk of encoded_text.
+    content: see utils.get_text_chunk()
+    readings: the readings table of the compact format,
+        see EncodedText.get_readings_tables()
+    '''
+    region_type = encoded_text.abstracted_text.type.slug
+    if region_type not in ['work', 'version']:
+        region_type = 'version'
+
+    # the highest number of regions in a sentence
+    value_max = max(
+        [1] + encoded_text.get_region_counts()[region_type]
+    )
 
+    attributes = OrderedDict([
+        ['view', view],
+        ['unit', unit],
+        ['location', location],
+        ['value_max', value_max],
+        ['region_type', region_type],
+        ['description', 'number of unsettled regions per sentence'],
+        ['chunk', utils.get_text_chunk(
+            encoded_text, view, region_type, content)],
+    ])
+    if readings is not None:
+        attributes['format'] = 'compact'
+        attributes['readings'] = readings
+
+    return OrderedDict([
+        ['id', encoded_text.id],
+        ['type', 'text_chunk'],
+        ['attributes', attributes],
+        ['relationships', OrderedDict([
+            ['text', OrderedDict([
+                ['data', OrderedDict([
+                    ['type', encoded_text.abstracted_text.type.slug],
+                    ['id', encoded_text.abstracted_text_id],
+                ])],
+            ])],
+        ])],
+    ])
 
+
+@api_cache()
 def view_api_text_chunk(
     request, text_slug, view='transcription', unit='', location=''
 ):
@@ -82,6 +328,15 @@ def view_api_text_chunk(
     Returns json with the requested data chunk.
     A chunk can be anything: XML, json, html, ...
     http://localhost:8000/api/texts/490/transcription/whole/whole/
+
+    ?format=compact: the chunk is the content of the text without the
+    readings of its members, they are in the 'readings' attribute,
+    see EncodedText.get_readings_tables().
+
+    Comparative chunk: with comma-separated text ids (or slugs),
+    data is the list of the chunks of those texts, in the same order
+    (texts without that encoding are skipped).
+    http://localhost:8000/api/texts/490,495/transcription/whole/whole/
     '''
     slugs = text_slug.split(',')
 
@@ -90,54 +345,71 @@ def view_api_text_chunk(
         encoded_type = 'transcription'
 
     try:
-        filters = {'abstracted_text__id__in': [int(s) for s in slugs]}
+        slugs = [int(s) for s in slugs]
+        field = 'abstracted_text_id'
     except ValueError:
-        filters = {'abstracted_text__slug__in': slugs}
+        field = 'abstracted_text__slug'
 
-    encoded_texts = EncodedText.objects.filter(
-        **filters
-    ).filter(type__slug=encoded_type)
+    encoded_texts = list(EncodedText.objects.filter(
+        **{field + '__in': slugs}
+    ).filter(
+        type__slug=encoded_type
+    ).select_related(
+        'abstracted_text__type'
+    ).order_by('id'))
+
+    contents = {}
+    readings = {}
+    if view not in ['histogram']:
+        if request.GET.get('format', '') == 'compact':
+            # the content without the readings + the table of the readings
+            contents = {
+                encoded_text.id: encoded_text.content or ''
+                for encoded_text in encoded_texts
+            }
+            readings = EncodedText.get_readings_tables(encoded_texts)
+        else:
+            contents = EncodedText.get_contents_with_readings(encoded_texts)
+
+    # one chunk per requested text, in the requested order
+    texts = {}
+    for encoded_text in encoded_texts:
+        key = encoded_text.abstracted_text_id
+        if field != 'abstracted_text_id':
+            key = encoded_text.abstracted_text.slug
+        texts.setdefault(key, encoded_text)
+
+    chunks = [
+        get_text_chunk_resource(
+            texts[slug], view, unit, location, contents.get(texts[slug].id),
+            readings.get(texts[slug].id)
+        )
+        for slug in OrderedDict.fromkeys(slugs)
+        if slug in texts
+    ]
 
     data = {}
-    if encoded_texts.count() == 1:
+    if len(slugs) > 1:
+        # comparative chunk
+        data = chunks
+    elif chunks:
         # individual chunk
-        encoded_text = encoded_texts[0]
-
-        region_type = encoded_text.abstracted_text.type.slug
-        if region_type not in ['work', 'version']:
-            region_type = 'version'
-
-        data = OrderedDict([
-            ['id', encoded_text.id],
-            ['type', 'text_chunk'],
-            ['attributes', OrderedDict([
-                ['view', view],
-                ['unit', unit],
-                ['location', location],
-                ['value_max', 17],
-                ['region_type', region_type],
-                ['description', 'number of unsettled regions per sentence'],
-                ['chunk', utils.get_text_chunk(
-                    encoded_text, view, region_type)],
-            ])],
-        ])
-
-    if encoded_texts.count() > 1:
-        # TODO: comparative chunk
-        pass
+        data = chunks[0]
 
     ret = OrderedDict([
         ['jsonapi', '1.0'],
         ['data', data],
     ])
 
-    return JsonResponse(ret)
+    return JsonApiResponse(ret)
 
 # -------------------------------------------------------------------
 
 
+@api_cache()
 def view_api_text_search_sentences(request):
     '''
+    Returns json with the sentence number ?sn= of the texts ?texts=
     '''
 
     text_ids = request.GET.get('texts', '') or '0'
@@ -151,17 +423,22 @@ def view_api_text_search_sentences(request):
     ).order_by(
         'abstracted_text__group__short_name',
         'abstracted_text__short_name'
-    )
+    ).select_related('abstracted_text__type')
+
+    # {encoded_text_id: html}, only the first occurrence of a number
+    sentences = {}
+    for sentence in Sentence.objects.filter(
+        encoded_text__in=encoded_texts,
+        number=sentence_number,
+        auxiliary=False,
+    ).exclude(number='').order_by('-ordinal').only('encoded_text_id', 'html'):
+        sentences[sentence.encoded_text_id] = sentence.html
 
     texts = []
     for encoded_text in encoded_texts:
-        sentence = utils.get_sentence_from_text(
-            encoded_text, sentence_number
-        )
-
         html = render_to_string('ctrs_texts/search_sentence.html', {
             'text': encoded_text.abstracted_text,
-            'sentence': sentence,
+            'sentence': sentences.get(encoded_text.id, ''),
         })
 
         text_data = {
@@ -174,12 +451,15 @@ def view_api_text_search_sentences(request):
         ['data', texts],
     ])
 
-    return JsonResponse(ret)
+    return JsonApiResponse(ret)
 
 
 # -------------------------------------------------------------------
 
 
+@api_cache(
+    get_regions_etag, get_regions_last_modified, get_regions_cache_key_extra
+)
 def view_api_text_search_regions(request):
     '''
     '''
@@ -188,77 +468,142 @@ def view_api_text_search_regions(request):
     text_ids = request.GET.get('texts', '') or '520'
     text_ids = text_ids.split(',')
 
-    annotations = utils.get_annotations_from_archetype()
-
-    hits = [{
-        'type': 'heatmap',
-        'id': 0,
-        'html': render_to_string('ctrs_texts/search_region.html', {}),
-        'regions': utils.get_regions_with_unique_variants(text_ids),
-        'annotations': annotations,
-    }]
+    # the regions are read and sent one at a time
+    # the annotations are only encoded when their file changes
+    hits = [OrderedDict([
+        ['type', 'heatmap'],
+        ['id', 0],
+        ['html', render_to_string('ctrs_texts/search_region.html', {})],
+        ['regions', utils.iter_regions_with_unique_variants(text_ids)],
+        ['annotations', serializers.JSONFragment(
+            utils.get_annotations_from_archetype(serialized=True)
+        )],
+    ])]
 
     ret = OrderedDict([
         ['jsonapi', '1.0'],
         ['data', hits],
     ])
 
-    return JsonResponse(ret)
+    return JsonApiStreamingResponse(ret)
 
 
+@api_cache()
 def view_api_text_search_text(request):
     q = request.GET.get('q', '')
     if q:
         q = q.strip()
 
-    text_ids = request.GET.get('texts', None)
     encoding_type = request.GET.get('et', 'transcription')
 
-    encoded_texts = EncodedText.objects.filter(type__slug=encoding_type)
-
-    if text_ids:
-        text_ids = text_ids.split(',')
-        encoded_texts = encoded_texts.filter(abstracted_text__id__in=text_ids)
+    try:
+        text_ids = get_int_list_param(request, 'texts')
 
-    # match only words that begin with the search query
-    # needs to use PSQL regex syntax, not Python's
-    # https://www.postgresql.org/docs/9.4/functions-matching.html#POSIX-CONSTRAINT-ESCAPES-TABLE
-    encoded_texts = encoded_texts.filter(
-        plain__iregex=r'\m{}'.format(q)).order_by(
-        'abstracted_text__group__short_name',
-        'abstracted_text__short_name'
+        # pagination: ?limit=&page= or ?limit=&cursor= (see links.next)
+        limit = min(
+            get_int_param(request, 'limit', search.get_page_size(), 1),
+            search.PAGE_SIZE_MAX
+        )
+        page = get_int_param(request, 'page', 1, 1)
+        offset = (page - 1) * limit
+        cursor = request.GET.get('cursor', None)
+        if cursor:
+            offset = search.get_offset_from_cursor(cursor)
+    except ValueError as e:
+        return JsonApiErrorResponse(str(e))
+
+    # sentences with words beginning with each word of the query
+    # only the requested page is fetched and rendered
+    total, sentence_ids = search.search_sentences(
+        q, encoding_type, text_ids, request.GET.get('order', 'rank'),
+        offset, limit, get_corpus_stats(request)[0]
     )
+    hits = Sentence.objects.select_related(
+        'encoded_text__abstracted_text__type'
+    ).in_bulk(sentence_ids)
+    # the index can briefly be out of date (e.g. during an import)
+    hits = [
+        hits[sentence_id] for sentence_id in sentence_ids
+        if sentence_id in hits
+    ]
 
-    search_pattern = utils.get_text_search_pattern()
-    escaped = '|'.join([search_pattern.format(w) for w in q.split()])
     # pattern to highlight the search results
-    # https://regexr.com/532qa
-    highlight_pattern = re.compile(
-        '({})(?=(?:[^>]|<[^>]*>)*$)'.format(escaped), re.I)
+    highlight_pattern = search.get_highlight_pattern(q)
 
-    sentences = []
-    for encoded_text in encoded_texts:
-        for sentence in utils.search_text(encoded_text, q):
+    def iter_sentences():
+        for hit in hits:
             html = render_to_string('ctrs_texts/search_sentence.html', {
-                'text': encoded_text.abstracted_text,
-                'sentence': sentence,
+                'text': hit.encoded_text.abstracted_text,
+                'sentence': hit.html,
             })
 
             # highlight the search results
-            if q:
-                html = highlight_pattern.sub(
-                    r'<span class="highlight">\1</span>', html)
+            html = utils.highlight_html(html, highlight_pattern)
 
-            sentence_data = {
+            yield {
                 'html': html,
             }
 
-            sentences.append(sentence_data)
+    next_url = None
+    if offset + limit < total:
+        params = request.GET.copy()
+        params.pop('page', None)
+        params['limit'] = limit
+        params['cursor'] = search.get_cursor(offset + limit)
+        next_url = '{}?{}'.format(request.path, params.urlencode())
 
+    # the sentences are rendered as the response is sent
     ret = OrderedDict([
         ['jsonapi', '1.0'],
         ['q', q],
-        ['data', sentences],
+        ['meta', OrderedDict([
+            ['total', total],
+            ['offset', offset],
+            ['limit', limit],
+        ])],
+        ['links', {
+            'next': next_url,
+        }],
+        ['data', iter_sentences()],
     ])
 
-    return JsonResponse(ret)
+    return JsonApiStreamingResponse(ret)
+
+
+def get_int_param(request, name, default, minimum):
+    '''
+    Returns the value of the integer parameter name in the query string,
+    default if it is missing.
+    Raises ValueError if it is not a number or lower than minimum.
+    '''
+    try:
+        ret = int(request.GET.get(name, default))
+    except ValueError:
+        ret = minimum - 1
+
+    if ret < minimum:
+        raise ValueError('Invalid {}: {}, must be an integer >= {}'.format(
+            name, request.GET.get(name), minimum
+        ))
+
+    return ret
+
+
+def get_int_list_param(request, name):
+    '''
+    Returns the list of comma-separated integers of the parameter name
+    in the query string, None if it is missing or empty.
+    Raises ValueError if an item is not an integer.
+    '''
+    value = request.GET.get(name, '')
+    if not value:
+        return None
+
+    try:
+        return [int(item) for item in value.split(',')]
+    except ValueError:
+        raise ValueError(
+            'Invalid {}: {}, must be comma-separated integers'.format(
+                name, value
+            )
+        )